@@ -0,0 +1,148 @@
+import asyncio
+import click
+import time
+
+from dibridge import discord as dibridge_discord
+from dibridge import relay
+from dibridge.irc_puppet import PuppetReactor
+from dibridge.translate import discord_to_irc
+
+from . import corpus
+from . import stubs
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+
+    return decorator
+
+
+def _register_relay_message(puppet_count):
+    @benchmark(f"irc: relay message ({puppet_count} puppets)")
+    def bench(loop):
+        nicknames = corpus.nicknames(puppet_count)
+        irc_relay = stubs.create_irc_relay(nicknames)
+        lines = corpus.irc_lines(1000, nicknames)
+
+        async def run():
+            for line in lines:
+                await irc_relay._relay_mesage("#openttd", "SomeIRCUser", line, 0)
+
+        return lambda: loop.run_until_complete(run()), len(lines)
+
+
+for _puppet_count in (10, 100, 1000):
+    _register_relay_message(_puppet_count)
+
+
+@benchmark("irc: sanitize discord username")
+def bench_sanitize(loop):
+    irc_relay = stubs.create_irc_relay([])
+    names = corpus.DISCORD_NAMES * 50
+
+    def run():
+        for name in names:
+            irc_relay._sanitize_discord_username(name)
+
+    return run, len(names)
+
+
+@benchmark("irc: generate ipv6 bits")
+def bench_generate_ipv6_bits(loop):
+    irc_relay = stubs.create_irc_relay([])
+    names = corpus.DISCORD_NAMES * 50
+
+    def run():
+        for name in names:
+            irc_relay._generate_ipv6_bits(name)
+
+    return run, len(names)
+
+
+@benchmark("irc: puppet receives channel line")
+def bench_puppet_channel_line(loop):
+    # Every puppet receives all channel traffic, which it ignores.
+    connection = PuppetReactor().server()
+    connection.buffer = connection.buffer_class()
+    connection.handlers = {}
+    connection.real_nickname = "SomePuppet"
+    lines = corpus.irc_lines(1000, [])
+    data = "".join(f":SomeIRCUser!user@host PRIVMSG #openttd :{line}\r\n" for line in lines).encode()
+
+    return lambda: connection.process_data(data), len(lines)
+
+
+def _discord_corpus(paste_lines):
+    users = {user_id: name for user_id, name in enumerate(corpus.nicknames(100), start=10**17)}
+    channels = {2 * 10**17 + i: f"channel-{i}" for i in range(10)}
+    roles = {3 * 10**17 + i: f"Role {i}" for i in range(10)}
+    count = 20 if paste_lines else 1000
+    messages = corpus.discord_messages(count, list(users), list(channels), list(roles), paste_lines)
+    return users, channels, roles, messages
+
+
+def _register_translate(paste_lines):
+    @benchmark(f"discord: translate to irc ({paste_lines or 'no'} pasted lines)")
+    def bench(loop):
+        users, channels, roles, messages = _discord_corpus(paste_lines)
+
+        def run():
+            for content in messages:
+                discord_to_irc(content, users, channels, roles)
+
+        return run, len(messages)
+
+    @benchmark(f"discord: on_message ({paste_lines or 'no'} pasted lines)")
+    def bench_on_message(loop):
+        users, channels, roles, messages = _discord_corpus(paste_lines)
+
+        client = dibridge_discord.RelayDiscord({1234: "#openttd"}, 0, 1, False, None, 100, 300)
+        relay.IRC = stubs.StubIRC()
+        messages = [stubs.create_discord_message(1234, content, users, channels, roles) for content in messages]
+
+        async def run():
+            for message in messages:
+                await client.on_message(message)
+
+        return lambda: loop.run_until_complete(run()), len(messages)
+
+
+for _paste_lines in (0, 100):
+    _register_translate(_paste_lines)
+
+
+@click.command()
+@click.option("--filter", "name_filter", help="Only run benchmarks with this text in their name.", default="")
+@click.option("--min-time", help="Minimum time to run each benchmark for, in seconds.", default=2.0)
+def main(name_filter, min_time):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    click.echo(f"{'benchmark':<50} {'ops/s':>12} {'us/op':>10}")
+    for name, setup in BENCHMARKS:
+        if name_filter not in name:
+            continue
+
+        run, ops_per_run = setup(loop)
+        # Warm up caches, compiled regexes, etc.
+        run()
+
+        runs = 0
+        start = time.perf_counter()
+        while True:
+            run()
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+
+        ops = runs * ops_per_run
+        click.echo(f"{name:<50} {ops / elapsed:>12.0f} {elapsed / ops * 1_000_000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import random
+
+# Fixed seed, so every run benchmarks the exact same corpus.
+SEED = 2022
+
+WORDS = (
+    "the a to is it that you and of in for this on have but not with be are was just so what can if do about "
+    "train station signal depot road vehicle company bankrupt loan bridge tunnel savegame patch release nightly "
+    "openttd game server client build crash desync version newgrf ai script map town industry cargo"
+).split()
+URLS = [
+    "https://www.openttd.org/downloads/openttd-releases/latest",
+    "https://github.com/OpenTTD/OpenTTD/pull/12345",
+    "http://example.com/a/b/c?d=e",
+]
+DISCORD_NAMES = [
+    "TrueBrain",
+    "glx",
+    "Rubidium",
+    "_dp_",
+    "frosch123",
+    "peter1138",
+    "Zorg",
+    "JGR",
+    "michi_cc",
+    "LordAro",
+    "  spaced name  ",
+    "Ünïcödé",
+    "日本語の名前",
+    "1337-start",
+    "[brackets]",
+    "name.with.dots",
+    "very_long_discord_username_that_is_too_long",
+]
+
+
+def nicknames(count):
+    # Nicknames as the bridge would generate them for puppets.
+    return [f"{random.Random(i).choice(DISCORD_NAMES).strip()[:12]}{i}" for i in range(count)]
+
+
+def irc_lines(count, puppet_nicknames):
+    rng = random.Random(SEED)
+    lines = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 25))]
+
+        # Every so often, mention a puppet (sometimes the IRC way, with "name: "), or post an URL.
+        if puppet_nicknames and rng.random() < 0.3:
+            nickname = rng.choice(puppet_nicknames)
+            if rng.random() < 0.5:
+                words.insert(0, f"{nickname}:")
+            else:
+                words.insert(rng.randrange(len(words)), nickname)
+        if rng.random() < 0.1:
+            words.insert(rng.randrange(len(words)), rng.choice(URLS))
+
+        lines.append(" ".join(words))
+    return lines
+
+
+def discord_messages(count, user_ids, channel_ids, role_ids, paste_lines=0):
+    rng = random.Random(SEED)
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words) + 1), f"<@{rng.choice(user_ids)}>")
+        if rng.random() < 0.1:
+            words.insert(0, f"<@{rng.choice(user_ids)}>")
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), f"<#{rng.choice(channel_ids)}>")
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), f"<@&{rng.choice(role_ids)}>")
+        if rng.random() < 0.1:
+            words.append(f"<:openttd:{rng.randrange(10**17, 10**18)}>")
+        if rng.random() < 0.1:
+            words.insert(rng.randrange(len(words)), rng.choice(URLS))
+
+        content = " ".join(words)
+        if paste_lines:
+            # A long paste, like a crash log or a code-block.
+            paste = "\n".join(
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 120))) for _ in range(paste_lines)
+            )
+            content = f"{content}\n```\n{paste}\n```"
+        messages.append(content)
+    return messages
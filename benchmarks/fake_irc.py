@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import socket
+import time
+
+SERVER_NAME = "fake.irc"
+
+
+class Client:
+    def __init__(self, writer, flood_rate, flood_burst):
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.oper = False
+        self.channels = set()
+
+        self._flood_rate = flood_rate
+        self._flood_burst = flood_burst
+        self._tokens = flood_burst
+        self._last_refill = time.monotonic()
+
+    @property
+    def prefix(self):
+        return f"{self.nick}!{self.user}@loopback"
+
+    def send(self, line):
+        self.writer.write(f"{line}\r\n".encode())
+
+    def is_flooding(self):
+        # Like a real IRC server, a client that sends too much too fast is
+        # disconnected. Operators are exempt.
+        if self.oper:
+            return False
+
+        now = time.monotonic()
+        self._tokens = min(self._flood_burst, self._tokens + (now - self._last_refill) * self._flood_rate)
+        self._last_refill = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+
+class FakeIRCServer:
+    # Just enough of an IRC server to soak the bridge: NICK, USER, JOIN, PART,
+    # PRIVMSG, PING, QUIT, OPER and KILL, with flood limits.
+    def __init__(self, flood_rate, flood_burst):
+        self._flood_rate = flood_rate
+        self._flood_burst = flood_burst
+        self._clients = {}
+        self._channels = collections.defaultdict(set)
+
+    async def serve(self, sock):
+        server = await asyncio.start_server(self._handle, sock=sock)
+        await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        client = Client(writer, self._flood_rate, self._flood_burst)
+
+        try:
+            while line := await reader.readline():
+                if client.is_flooding():
+                    self._close(client, "Excess Flood")
+                    return
+
+                self._handle_line(client, line.decode(errors="replace").rstrip("\r\n"))
+                if writer.is_closing():
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self._close(client, "Connection closed")
+
+    def _handle_line(self, client, line):
+        params, separator, trailing = line.partition(" :")
+        command, *params = params.split(" ")
+        if separator:
+            params.append(trailing)
+
+        handler = getattr(self, f"_command_{command.lower()}", None)
+        if handler is None:
+            return
+        if not client.registered and command not in ("NICK", "USER"):
+            client.send(f":{SERVER_NAME} 451 * :You have not registered")
+            return
+        handler(client, *params)
+
+    def _broadcast(self, channel, line, exclude=None):
+        for member in self._channels[channel]:
+            if member is not exclude:
+                member.send(line)
+
+    def _peers(self, client):
+        # Everyone who shares a channel with this client.
+        peers = set()
+        for channel in client.channels:
+            peers.update(self._channels[channel])
+        peers.discard(client)
+        return peers
+
+    def _command_nick(self, client, nick, *_):
+        if nick in self._clients and self._clients[nick] is not client:
+            client.send(f":{SERVER_NAME} 433 {client.nick or '*'} {nick} :Nickname is already in use")
+            return
+
+        if client.registered:
+            line = f":{client.prefix} NICK :{nick}"
+            client.send(line)
+            for peer in self._peers(client):
+                peer.send(line)
+        if self._clients.get(client.nick) is client:
+            del self._clients[client.nick]
+        client.nick = nick
+        self._clients[nick] = client
+        self._register(client)
+
+    def _command_user(self, client, user, *_):
+        client.user = user
+        self._register(client)
+
+    def _register(self, client):
+        if client.registered or client.nick is None or client.user is None:
+            return
+
+        client.registered = True
+        client.send(f":{SERVER_NAME} 001 {client.nick} :Welcome to the fake IRC network")
+
+    def _command_oper(self, client, *_):
+        client.oper = True
+        client.send(f":{SERVER_NAME} 381 {client.nick} :You are now an IRC operator")
+
+    def _command_ping(self, client, token, *_):
+        client.send(f":{SERVER_NAME} PONG {SERVER_NAME} :{token}")
+
+    def _command_join(self, client, channels, *_):
+        for channel in channels.split(","):
+            if channel in client.channels:
+                continue
+
+            client.channels.add(channel)
+            self._channels[channel].add(client)
+            self._broadcast(channel, f":{client.prefix} JOIN {channel}")
+
+    def _command_part(self, client, channels, *_):
+        for channel in channels.split(","):
+            if channel not in client.channels:
+                continue
+
+            self._broadcast(channel, f":{client.prefix} PART {channel}")
+            client.channels.discard(channel)
+            self._channels[channel].discard(client)
+
+    def _command_privmsg(self, client, target, message=""):
+        line = f":{client.prefix} PRIVMSG {target} :{message}"
+        if target.startswith("#"):
+            self._broadcast(target, line, exclude=client)
+        elif target in self._clients:
+            self._clients[target].send(line)
+
+    def _command_quit(self, client, *_):
+        self._close(client, "Quit")
+
+    def _command_kill(self, client, nick, reason="Killed"):
+        target = self._clients.get(nick)
+        if not client.oper or target is None:
+            return
+
+        target.send(f":{client.prefix} KILL {nick} :{reason}")
+        self._close(target, f"Killed ({client.nick} ({reason}))")
+
+    def _close(self, client, reason):
+        if client.writer.is_closing():
+            return
+
+        for peer in self._peers(client):
+            peer.send(f":{client.prefix} QUIT :{reason}")
+        for channel in client.channels:
+            self._channels[channel].discard(client)
+        client.channels.clear()
+        if self._clients.get(client.nick) is client:
+            del self._clients[client.nick]
+
+        client.send(f"ERROR :Closing Link: {reason}")
+        client.writer.close()
+
+
+def create_socket():
+    # The socket is created by the harness, so it knows the port before the
+    # server process is started.
+    return socket.create_server(("::1", 0), family=socket.AF_INET6, backlog=4096)
+
+
+def run(sock, flood_rate, flood_burst):
+    # Entry point of the server process.
+    asyncio.run(FakeIRCServer(flood_rate, flood_burst).serve(sock))
@@ -0,0 +1,402 @@
+import asyncio
+import click
+import discord
+import ipaddress
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import time
+import types
+
+from openttd_helpers.asyncio_helper import enable_strong_referenced_tasks
+
+from dibridge import discord as dibridge_discord
+from dibridge import irc
+from dibridge import relay
+
+from . import corpus
+from . import fake_irc
+from . import stubs
+
+# Soak the bridge end-to-end: a fake IRC server (in its own process), the
+# real IRCRelay with real IRC puppets, and a RelayDiscord that is never
+# logged in, but is driven by the harness and captures what is sent via
+# its webhooks. Every message carries an ID, to measure its latency.
+
+CHANNEL_ID = 1234
+CHANNEL = "#openttd"
+REGEX_SOAK_ID = re.compile(r"\bsoak-([0-9]+)\b")
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self._sent = {}
+        self._started_at = time.monotonic()
+        self._last_received_at = self._started_at
+
+    @property
+    def pending(self):
+        return len(self._sent)
+
+    def sent(self, message_id):
+        self._sent[message_id] = time.monotonic()
+
+    def received(self, message):
+        match = REGEX_SOAK_ID.search(message)
+        if not match:
+            return
+
+        sent_at = self._sent.pop(int(match.group(1)), None)
+        if sent_at is None:
+            return
+
+        self._last_received_at = time.monotonic()
+        self.latencies.append(self._last_received_at - sent_at)
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return f"{self.name:<30} {self.pending:>8} {0:>8} {'-':>10} {'-':>9} {'-':>9} {'-':>9}"
+
+        def quantile(q):
+            return latencies[int(q * (len(latencies) - 1))] * 1000
+
+        rate = len(latencies) / max(self._last_received_at - self._started_at, 0.000001)
+        return (
+            f"{self.name:<30} {len(latencies) + self.pending:>8} {len(latencies):>8} {rate:>10.1f} "
+            f"{quantile(0.5):>9.1f} {quantile(0.99):>9.1f} {latencies[-1] * 1000:>9.1f}"
+        )
+
+
+class FakeWebhook:
+    # Stands in for a discord.py Webhook; captures what is sent, instead of
+    # sending it to Discord. The delay simulates the round-trip to Discord.
+    _message_ids = itertools.count(10**18)
+
+    def __init__(self, webhook_id, delay, received_func):
+        self.id = webhook_id
+        self._delay = delay
+        self._received_func = received_func
+
+    async def send(self, content, **kwargs):
+        if self._delay:
+            await asyncio.sleep(self._delay)
+        self._received_func(content)
+        return types.SimpleNamespace(id=next(self._message_ids))
+
+
+class FakeChannel:
+    async def send(self, message):
+        pass
+
+
+class SoakDiscord(dibridge_discord.RelayDiscord):
+    # A RelayDiscord that never logs in.
+    async def _update_presence(self, status):
+        self._status = status
+
+
+class IRCUser:
+    # A user on the fake IRC server; talks in the channel, and sees what
+    # the puppets say there. It is an IRC operator, so it is not limited by
+    # the flood limits of the server.
+    def __init__(self, nickname, received_func):
+        self.nickname = nickname
+        self._received_func = received_func
+        self._joined = asyncio.Event()
+
+    async def connect(self, port):
+        reader, self._writer = await asyncio.open_connection("::1", port)
+        self._send(f"NICK {self.nickname}")
+        self._send(f"USER {self.nickname} 0 * :{self.nickname}")
+        self._send("OPER soak soak")
+        self._send(f"JOIN {CHANNEL}")
+        asyncio.create_task(self._reader(reader))
+        await self._joined.wait()
+
+    def _send(self, line):
+        self._writer.write(f"{line}\r\n".encode())
+
+    async def _reader(self, reader):
+        while line := await reader.readline():
+            line = line.decode(errors="replace")
+            if f" PRIVMSG {CHANNEL} :" in line:
+                self._received_func(line.partition(f" PRIVMSG {CHANNEL} :")[2])
+            elif line.startswith(f":{self.nickname}!") and " JOIN " in line:
+                self._joined.set()
+
+    def say(self, message):
+        self._send(f"PRIVMSG {CHANNEL} :{message}")
+
+    def kill(self, nickname):
+        self._send(f"KILL {nickname} :Soak test")
+
+
+def _rss(pids):
+    # Resident memory of the given processes together, in KiB.
+    total = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+    return total
+
+
+async def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return condition()
+
+
+async def _paced(count, rate, func):
+    # Call func count times, spread evenly at rate calls per second.
+    started_at = time.monotonic()
+    for i in range(count):
+        delay = started_at + i / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await func(i)
+
+
+class Soak:
+    def __init__(self, options):
+        self._options = options
+        self._message_ids = itertools.count()
+        self._rng = random.Random(corpus.SEED)
+        self._to_irc = None
+        self._to_discord = None
+        self.phases = []
+
+    async def run(self):
+        enable_strong_referenced_tasks(asyncio.get_running_loop())
+        options = self._options
+
+        sock = fake_irc.create_socket()
+        port = sock.getsockname()[1]
+        server = multiprocessing.get_context("spawn").Process(
+            target=fake_irc.run,
+            args=(sock, options["server_flood_rate"], options["server_flood_burst"]),
+            name="fake-irc",
+            daemon=True,
+        )
+        server.start()
+        sock.close()
+
+        self._irc_users = [IRCUser(f"ircuser{i}", self._on_irc_message) for i in range(options["irc_users"])]
+        for irc_user in self._irc_users:
+            await irc_user.connect(port)
+
+        webhooks = [
+            FakeWebhook(webhook_id, options["webhook_delay"], self._on_webhook_message)
+            for webhook_id in range(options["webhook_pool_size"])
+        ]
+        relay.DISCORD = self._discord = SoakDiscord({CHANNEL_ID: CHANNEL}, 0, len(webhooks), False, None, 100, 300)
+        self._discord.loop = asyncio.get_running_loop()
+        self._discord._relaying = True
+        bridged = self._discord._channels[CHANNEL_ID]
+        bridged._channel = FakeChannel()
+        bridged._webhook_pool.set_webhooks(webhooks)
+
+        relay.IRC = self._irc = irc.IRCRelay(
+            "::1",
+            port,
+            "bridge",
+            [CHANNEL],
+            ipaddress.ip_network(options["puppet_ip_range"]),
+            "",
+            [],
+            3600,
+            options["flood_rate"],
+            options["flood_burst"],
+            options["connect_concurrency"],
+            None,
+            0,
+            1000,
+            options["workers"],
+            100,
+            300,
+        )
+        for worker in self._irc._puppet_workers:
+            await worker.start()
+        await self._irc._connect()
+        if not await _wait_for(lambda: CHANNEL in self._irc._joined_channels, 10):
+            raise click.ClickException("Bridge did not join the IRC channel")
+
+        pids = [os.getpid()] + [worker._process.pid for worker in self._irc._puppet_workers]
+        self.rss_before = _rss(pids)
+
+        # Every Discord user says something, so every user gets a puppet.
+        self._discord_users = dict(enumerate(corpus.nicknames(options["puppets"]), start=10**17))
+        discord_messages = corpus.discord_messages(
+            max(options["messages"], options["puppets"]), list(self._discord_users), [1], [2]
+        )
+        await self._phase(
+            f"connect ({options['puppets']} puppets)",
+            "discord",
+            options["puppets"],
+            options["connect_rate"],
+            lambda i: self._discord_say(list(self._discord_users)[i], discord_messages[i]),
+        )
+        self.rss_after = _rss(pids)
+        self.puppets = len(self._irc._puppets)
+
+        await self._churn_presence()
+        await self._kill_puppets(options["kill"])
+
+        user_ids = list(self._discord_users)
+        await self._phase(
+            "discord -> irc",
+            "discord",
+            options["messages"],
+            options["rate"],
+            lambda i: self._discord_say(self._rng.choice(user_ids), discord_messages[i]),
+        )
+
+        irc_lines = corpus.irc_lines(options["messages"], list(self._irc._puppet_nicknames))
+        await self._phase(
+            "irc -> discord",
+            "irc",
+            options["messages"],
+            options["rate"],
+            lambda i: self._irc_say(self._irc_users[i % len(self._irc_users)], irc_lines[i]),
+        )
+
+        # Everything is measured; quietly leave everything behind.
+        logging.disable(logging.CRITICAL)
+        server.kill()
+
+    async def _phase(self, name, source, count, rate, func):
+        phase = Phase(name)
+        self.phases.append(phase)
+        if source == "discord":
+            self._to_irc = phase
+        else:
+            self._to_discord = phase
+
+        await _paced(count, rate, func)
+        await _wait_for(lambda: phase.pending == 0, self._options["drain_timeout"])
+
+    async def _discord_say(self, discord_id, content):
+        message_id = next(self._message_ids)
+        message = stubs.create_discord_message(
+            CHANNEL_ID,
+            f"soak-{message_id} {content}",
+            self._discord_users,
+            {1: "general"},
+            {2: "Role"},
+            discord_id,
+            self._discord_users[discord_id],
+        )
+        self._to_irc.sent(message_id)
+        await self._discord.on_message(message)
+
+    async def _irc_say(self, irc_user, line):
+        message_id = next(self._message_ids)
+        self._to_discord.sent(message_id)
+        irc_user.say(f"soak-{message_id} {line}")
+
+    def _on_irc_message(self, message):
+        # Every IRC user sees the puppets talk; only count it once.
+        if self._to_irc is not None:
+            self._to_irc.received(message)
+
+    def _on_webhook_message(self, message):
+        if self._to_discord is not None:
+            self._to_discord.received(message)
+
+    async def _churn_presence(self):
+        # Every tenth user goes offline on Discord, and comes back; this
+        # starts and stops the idle timeout of their puppet.
+        for status in (discord.Status.offline, discord.Status.online):
+            for discord_id in list(self._discord_users)[::10]:
+                member = types.SimpleNamespace(id=discord_id, status=status)
+                await self._discord.on_presence_update(member, member)
+
+    async def _kill_puppets(self, count):
+        # The puppet of a killed user is removed; it is created again once
+        # the user talks again.
+        nicknames = list(self._irc._puppet_nicknames)
+        count = min(count, len(nicknames))
+        for nickname in self._rng.sample(nicknames, count):
+            self._irc_users[0].kill(nickname)
+
+        remaining = len(self._irc._puppets) - count
+        await _wait_for(lambda: len(self._irc._puppets) <= remaining, 10)
+
+
+@click.command()
+@click.option("--puppets", help="Amount of Discord users, and so IRC puppets.", default=1000)
+@click.option("--messages", help="Amount of messages to relay in each direction.", default=2000)
+@click.option("--rate", help="Messages per second to send in each direction.", default=100.0)
+@click.option("--connect-rate", help="Messages per second to send while creating the puppets.", default=100.0)
+@click.option("--irc-users", help="Amount of (non-puppet) users on IRC talking in the channel.", default=10)
+@click.option("--workers", help="Amount of IRC puppet worker processes.", default=0)
+@click.option("--connect-concurrency", help="Maximum amount of IRC puppets connecting at the same time.", default=5)
+@click.option(
+    "--flood-rate",
+    help="Lines per second an IRC connection of the bridge may send.",
+    default=0.5,
+    type=click.FloatRange(0, min_open=True),
+)
+@click.option(
+    "--flood-burst",
+    help="Lines an IRC connection of the bridge may send in a single burst.",
+    default=5,
+    type=click.IntRange(1),
+)
+@click.option("--server-flood-rate", help="Lines per second the fake IRC server accepts per client.", default=1.0)
+@click.option("--server-flood-burst", help="Lines the fake IRC server accepts per client in a burst.", default=10)
+@click.option(
+    "--puppet-ip-range",
+    help="IPv6 range the IRC puppets connect from; only ::1 is a loopback address by default.",
+    default="::1/128",
+)
+@click.option("--webhook-pool-size", help="Amount of (fake) webhooks to relay IRC messages with.", default=1)
+@click.option("--webhook-delay", help="Seconds each (fake) webhook message takes to send.", default=0.0)
+@click.option("--kill", help="Amount of puppets the IRC server kills after they connected.", default=0)
+@click.option("--drain-timeout", help="Seconds to wait for all messages to arrive after each phase.", default=30.0)
+@click.option("--max-p99", help="Fail if the p99 latency of a phase is higher than this, in milliseconds.", type=float)
+@click.option("--verbose", help="Show the logging of the bridge.", is_flag=True)
+def main(verbose, max_p99, **options):
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO if verbose else logging.ERROR,
+    )
+
+    # Every puppet is a connection on both ends.
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    soak = Soak(options)
+    asyncio.run(soak.run())
+
+    click.echo(f"{'phase':<30} {'sent':>8} {'relayed':>8} {'msgs/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for phase in soak.phases:
+        click.echo(phase.report())
+    rss_per_puppet = (soak.rss_after - soak.rss_before) / max(soak.puppets, 1)
+    click.echo(
+        f"RSS: {soak.rss_before / 1024:.1f} MiB before, {soak.rss_after / 1024:.1f} MiB with {soak.puppets} puppets "
+        f"({rss_per_puppet:.1f} KiB per puppet)"
+    )
+
+    # As a regression gate, fail on lost or slow messages.
+    for phase in soak.phases:
+        if phase.pending:
+            raise click.ClickException(f"{phase.pending} messages were not relayed in phase '{phase.name}'")
+        if max_p99 is not None and phase.latencies:
+            p99 = sorted(phase.latencies)[int(0.99 * (len(phase.latencies) - 1))] * 1000
+            if p99 > max_p99:
+                raise click.ClickException(f"p99 latency of phase '{phase.name}' is {p99:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import discord
+import ipaddress
+import itertools
+import types
+
+from dibridge import irc
+from dibridge import relay
+
+
+class StubPuppet:
+    # Just enough of an IRCPuppet for the IRCRelay to relay messages.
+    def __init__(self, nickname):
+        self._nickname = nickname
+        self._joined = True
+        self.sent = 0
+
+    def is_offline(self):
+        return False
+
+    async def send_message(self, channel, content, relayed_at):
+        self.sent += 1
+
+    async def send_action(self, channel, content, relayed_at):
+        self.sent += 1
+
+
+class StubDiscord:
+    # Stands in for RelayDiscord, as seen from the IRC side.
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, irc_channel, irc_username, message, relayed_at):
+        self.sent += 1
+
+    def send_message_self(self, irc_channel, message):
+        pass
+
+    def add_puppet(self, discord_id):
+        pass
+
+    def remove_puppet(self, discord_id):
+        pass
+
+    def update_presence(self, status):
+        pass
+
+
+class StubIRC:
+    # Stands in for IRCRelay, as seen from the Discord side.
+    def __init__(self):
+        self.sent = 0
+
+    async def update_status(self, discord_id, is_offline):
+        pass
+
+    async def get_irc_usernames(self, discord_users):
+        return {discord_id: discord_username for discord_id, discord_username in discord_users.items()}
+
+    async def send_message(self, channel, discord_id, discord_username, message, relayed_at):
+        self.sent += 1
+
+    async def send_action(self, channel, discord_id, discord_username, message, relayed_at):
+        self.sent += 1
+
+
+def create_irc_relay(nicknames):
+    # An IRCRelay with puppets that never connect anywhere.
+    irc_relay = irc.IRCRelay(
+        "irc.example.com",
+        6697,
+        "bridge",
+        ["#openttd"],
+        ipaddress.ip_network("2001:db8::/80"),
+        "",
+        [],
+        3600,
+        0.5,
+        5,
+        5,
+        None,
+        0,
+        1000,
+        0,
+        100,
+        300,
+    )
+    for discord_id, nickname in enumerate(nicknames, start=10**17):
+        irc_relay._puppets[discord_id] = StubPuppet(nickname)
+        irc_relay._add_puppet_nickname(discord_id, nickname)
+
+    relay.DISCORD = StubDiscord()
+    return irc_relay
+
+
+_message_ids = itertools.count(10**18)
+
+
+def create_discord_message(channel_id, content, users, channels, roles, author_id=1, author_name="TrueBrain"):
+    # Just enough of a discord.py Message for RelayDiscord.on_message.
+    def mentioned(prefix, objects):
+        return [
+            types.SimpleNamespace(id=object_id, name=name)
+            for object_id, name in objects.items()
+            if f"{prefix}{object_id}>" in content
+        ]
+
+    return types.SimpleNamespace(
+        id=next(_message_ids),
+        channel=types.SimpleNamespace(id=channel_id),
+        author=types.SimpleNamespace(id=author_id, name=author_name, bot=False, status=discord.Status.online),
+        type=discord.MessageType.default,
+        content=content,
+        mentions=mentioned("<@", users),
+        channel_mentions=mentioned("<#", channels),
+        role_mentions=mentioned("<@&", roles),
+        attachments=[],
+        reference=None,
+    )
@@ -1,27 +1,66 @@
+import asyncio
 import click
 import ipaddress
 import logging
 import threading
 
 from openttd_helpers import click_helper
+from openttd_helpers.asyncio_helper import enable_strong_referenced_tasks
 from openttd_helpers.logging_helper import click_logging
 from openttd_helpers.sentry_helper import click_sentry
 
+from . import config
 from . import discord
 from . import irc
+from . import metrics
+from . import profiler
+from . import tracing
 
 log = logging.getLogger(__name__)
 
 
+async def run_shared_event_loop(discord_args, irc_args):
+    enable_strong_referenced_tasks(asyncio.get_running_loop())
+
+    # IRC goes first, as it creates its side of the relay before yielding.
+    await asyncio.gather(irc.run(*irc_args), discord.run(*discord_args))
+
+
 @click_helper.command()
 @click_logging  # Should always be on top, as it initializes the logging
 @click_sentry
 @click.option("--discord-token", help="Discord bot token to authenticate.", required=True)
-@click.option("--discord-channel-id", help="Discord channel ID to relay to.", required=True, type=int)
+@click.option("--discord-channel-id", help="Discord channel ID to relay to (when bridging a single channel).", type=int)
+@click.option(
+    "--discord-coalesce-window",
+    help="Merge consecutive IRC lines of the same user arriving within this many seconds into a single Discord "
+    "message (default: 0, disabled).",
+    default=0,
+    type=float,
+)
+@click.option(
+    "--discord-webhook-pool-size",
+    help="Amount of webhooks to relay IRC messages with; Discord rate limits per webhook (default: 1).",
+    default=1,
+    type=click.IntRange(1, 10),
+)
+@click.option(
+    "--discord-lean-member-cache",
+    help="Don't cache all members of the Discord server; only look up the members with an IRC puppet. "
+    "Uses less memory and starts faster on large servers.",
+    is_flag=True,
+)
 @click.option("--irc-host", help="IRC host to connect to.", required=True)
 @click.option("--irc-port", help="IRC SSL port to connect to.", default=6697, type=int)
 @click.option("--irc-nick", help="IRC nick to use.", required=True)
-@click.option("--irc-channel", help="IRC channel to relay to, without the first '#'.", required=True)
+@click.option("--irc-channel", help="IRC channel to relay to, without the first '#' (when bridging a single channel).")
+@click.option(
+    "--channel",
+    "channels",
+    help="Discord channel ID and IRC channel (without the first '#') to bridge, as ID:channel. Can be given "
+    "multiple times, to bridge multiple channels with a single Discord session and a single IRC puppet per user.",
+    multiple=True,
+)
 @click.option("--irc-puppet-ip-range", help="An IPv6 CIDR range to use for IRC puppets. (2001:A:B:C:D::/80)")
 @click.option("--irc-puppet-postfix", help="Postfix to add to IRC puppet nicknames (default: none).", default="")
 @click.option("--irc-ignore-list", help="IRC nicknames to not relay messages for (comma separated, case-insensitive).")
@@ -31,42 +70,201 @@ log = logging.getLogger(__name__)
     default=60 * 60 * 24 * 2,
     type=int,
 )
+@click.option(
+    "--irc-flood-rate",
+    help="Lines per second an IRC connection may send after its burst is used up (default: 0.5, as per RFC 1459).",
+    default=0.5,
+    type=click.FloatRange(0, min_open=True),
+)
+@click.option(
+    "--irc-flood-burst",
+    help="Lines an IRC connection may send in a single burst (default: 5, as per RFC 1459).",
+    default=5,
+    type=click.IntRange(1),
+)
+@click.option(
+    "--irc-connect-concurrency",
+    help="Maximum amount of IRC puppets connecting at the same time (default: 5).",
+    default=5,
+    type=click.IntRange(1),
+)
+@click.option(
+    "--irc-max-puppets",
+    help="Maximum amount of IRC puppets; when reached, the puppet of the least recently active user is removed "
+    "(default: 0, unlimited).",
+    default=0,
+    type=click.IntRange(0),
+)
+@click.option(
+    "--irc-recently-spoken-max",
+    help="Maximum amount of IRC users to remember as recently spoken, to announce on Discord when they leave "
+    "(default: 1000).",
+    default=1000,
+    type=click.IntRange(1),
+)
+@click.option(
+    "--irc-puppet-workers",
+    help="Amount of worker processes to spread IRC puppets over, to use more than one CPU core "
+    "(default: 0, puppets run in the main process).",
+    default=0,
+    type=click.IntRange(0),
+)
+@click.option(
+    "--replay-max-messages",
+    help="Maximum amount of messages per direction (and per IRC channel) to keep while the other side is down, "
+    "to relay once it is back; the oldest are dropped first (default: 100, 0 to disable).",
+    default=100,
+    type=click.IntRange(0),
+)
+@click.option(
+    "--replay-max-age",
+    help="Maximum age, in seconds, of a message kept while the other side is down (default: 300).",
+    default=300,
+    type=click.FloatRange(0),
+)
+@click.option(
+    "--config-file",
+    help="JSON file with settings that can be changed without a restart: discord_coalesce_window, "
+    "irc_ignore_list, irc_puppet_postfix and irc_idle_timeout. Overrides the command line; send SIGHUP to reload "
+    "it (default: none).",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--state-file",
+    help="SQLite file to remember IRC puppets and the Discord setup in, so both are restored quickly after a "
+    "restart (default: none).",
+    type=click.Path(dir_okay=False),
+)
+@click.option("--metrics-host", help="Host to serve Prometheus metrics on (default: 127.0.0.1).", default="127.0.0.1")
+@click.option("--metrics-port", help="Port to serve Prometheus metrics on (default: none, disabled).", type=int)
+@click.option(
+    "--trace",
+    help="Trace relayed messages; for every stage a message passes through, log a span with the time since it "
+    "was received.",
+    is_flag=True,
+)
+@click.option(
+    "--trace-file",
+    help="Write the spans of traced messages to this file (as JSON lines) instead of logging them. Implies --trace.",
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    "--shared-event-loop",
+    help="Run Discord and IRC on a single event loop, instead of each in their own thread.",
+    is_flag=True,
+)
 def main(
     discord_token,
     discord_channel_id,
+    discord_coalesce_window,
+    discord_webhook_pool_size,
+    discord_lean_member_cache,
     irc_host,
     irc_port,
     irc_nick,
     irc_channel,
+    channels,
     irc_puppet_ip_range,
     irc_puppet_postfix,
     irc_ignore_list,
     irc_idle_timeout,
+    irc_flood_rate,
+    irc_flood_burst,
+    irc_connect_concurrency,
+    irc_max_puppets,
+    irc_recently_spoken_max,
+    irc_puppet_workers,
+    replay_max_messages,
+    replay_max_age,
+    config_file,
+    state_file,
+    metrics_host,
+    metrics_port,
+    trace,
+    trace_file,
+    shared_event_loop,
 ):
+    bridged_channels = {}
+    if discord_channel_id or irc_channel:
+        if not discord_channel_id or not irc_channel:
+            raise Exception("--discord-channel-id and --irc-channel need to be used together.")
+        bridged_channels[discord_channel_id] = f"#{irc_channel}"
+    for channel in channels:
+        channel_id, _, channel_name = channel.partition(":")
+        if not channel_id.isdigit() or not channel_name:
+            raise Exception(f"--channel '{channel}' should be in the form of ID:channel.")
+        bridged_channels[int(channel_id)] = f"#{channel_name}"
+    if not bridged_channels:
+        raise Exception("No channels to bridge; use --channel, or --discord-channel-id with --irc-channel.")
+    if len(set(bridged_channels.values())) != len(bridged_channels):
+        raise Exception("An IRC channel can only be bridged with a single Discord channel.")
+
     if irc_puppet_ip_range:
         irc_puppet_ip_range = ipaddress.ip_network(irc_puppet_ip_range)
         if irc_puppet_ip_range.num_addresses < 2**32:
             raise Exception("--irc-puppet-ip-range needs to be an IPv6 CIDR range of at least /96 or more.")
 
-    if irc_ignore_list:
-        irc_ignore_list = [nickname.strip().lower() for nickname in irc_ignore_list.split(",") if nickname.strip()]
-    if not irc_ignore_list:
-        irc_ignore_list = []
-
-    thread_d = threading.Thread(target=discord.start, args=[discord_token, discord_channel_id])
-    thread_i = threading.Thread(
-        target=irc.start,
-        args=[
-            irc_host,
-            irc_port,
-            irc_nick,
-            f"#{irc_channel}",
-            irc_puppet_ip_range,
-            irc_puppet_postfix,
-            irc_ignore_list,
-            irc_idle_timeout,
-        ],
-    )
+    irc_ignore_list = config.parse_ignore_list(irc_ignore_list)
+
+    if config_file:
+        # The command line values are used for settings not in the file, also
+        # on reload.
+        defaults = {
+            "discord_coalesce_window": discord_coalesce_window,
+            "irc_ignore_list": irc_ignore_list,
+            "irc_puppet_postfix": irc_puppet_postfix,
+            "irc_idle_timeout": irc_idle_timeout,
+        }
+        settings = config.read(config_file, defaults)
+        discord_coalesce_window = settings["discord_coalesce_window"]
+        irc_ignore_list = settings["irc_ignore_list"]
+        irc_puppet_postfix = settings["irc_puppet_postfix"]
+        irc_idle_timeout = settings["irc_idle_timeout"]
+        config.install(config_file, defaults)
+
+    if metrics_port:
+        metrics.start(metrics_host, metrics_port)
+    if trace or trace_file:
+        tracing.enable(trace_file)
+    profiler.install()
+
+    discord_args = [
+        discord_token,
+        bridged_channels,
+        discord_coalesce_window,
+        discord_webhook_pool_size,
+        discord_lean_member_cache,
+        state_file,
+        replay_max_messages,
+        replay_max_age,
+    ]
+    irc_args = [
+        irc_host,
+        irc_port,
+        irc_nick,
+        list(bridged_channels.values()),
+        irc_puppet_ip_range,
+        irc_puppet_postfix,
+        irc_ignore_list,
+        irc_idle_timeout,
+        irc_flood_rate,
+        irc_flood_burst,
+        irc_connect_concurrency,
+        state_file,
+        irc_max_puppets,
+        irc_recently_spoken_max,
+        irc_puppet_workers,
+        replay_max_messages,
+        replay_max_age,
+    ]
+
+    if shared_event_loop:
+        asyncio.run(run_shared_event_loop(discord_args, irc_args))
+        return
+
+    # Named, so they can be told apart when profiling.
+    thread_d = threading.Thread(target=discord.start, args=discord_args, name="discord")
+    thread_i = threading.Thread(target=irc.start, args=irc_args, name="irc")
 
     thread_d.start()
     thread_i.start()
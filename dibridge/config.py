@@ -0,0 +1,84 @@
+import json
+import logging
+import signal
+import threading
+
+from . import relay
+
+log = logging.getLogger(__name__)
+
+# Settings that can be changed in the config file while the bridge is
+# running; send SIGHUP to apply them. Any setting not in the file uses the
+# value given on the command line.
+RELOADABLE_SETTINGS = {
+    "discord_coalesce_window": float,
+    "irc_ignore_list": None,
+    "irc_puppet_postfix": str,
+    "irc_idle_timeout": int,
+}
+
+_config_file = None
+_defaults = None
+
+
+def parse_ignore_list(ignore_list):
+    # Either comma separated (as on the command line), or a list.
+    if not ignore_list:
+        return []
+    if isinstance(ignore_list, str):
+        ignore_list = ignore_list.split(",")
+    return [nickname.strip().lower() for nickname in ignore_list if nickname.strip()]
+
+
+def read(config_file, defaults):
+    with open(config_file) as fp:
+        config = json.load(fp)
+
+    if not isinstance(config, dict):
+        raise Exception(f"Config file {config_file} should contain a JSON object.")
+    unknown = sorted(set(config) - set(RELOADABLE_SETTINGS))
+    if unknown:
+        raise Exception(f"Config file {config_file} contains unknown settings: {', '.join(unknown)}.")
+
+    settings = dict(defaults)
+    for name, value in config.items():
+        if RELOADABLE_SETTINGS[name]:
+            value = RELOADABLE_SETTINGS[name](value)
+        settings[name] = value
+    settings["irc_ignore_list"] = parse_ignore_list(settings["irc_ignore_list"])
+
+    if settings["discord_coalesce_window"] < 0:
+        raise Exception("discord_coalesce_window cannot be negative.")
+    if settings["irc_idle_timeout"] <= 0:
+        raise Exception("irc_idle_timeout should be positive.")
+    return settings
+
+
+def _reload():
+    try:
+        settings = read(_config_file, _defaults)
+    except Exception:
+        log.exception("Failed to reload config file %s; keeping the current settings", _config_file)
+        return
+
+    if relay.IRC is None or relay.DISCORD is None:
+        log.info("Not reloading config file %s; the bridge is still starting", _config_file)
+        return
+
+    log.info("Reloading config file %s", _config_file)
+    relay.IRC.reload(settings["irc_ignore_list"], settings["irc_puppet_postfix"], settings["irc_idle_timeout"])
+    relay.DISCORD.reload(settings["discord_coalesce_window"])
+
+
+def _on_signal(signum, frame):
+    # Reading the file is done outside of the signal handler, which might
+    # be running on one of the event loops.
+    threading.Thread(target=_reload, name="config-reload", daemon=True).start()
+
+
+def install(config_file, defaults):
+    global _config_file, _defaults
+    _config_file = config_file
+    _defaults = defaults
+
+    signal.signal(signal.SIGHUP, _on_signal)
@@ -0,0 +1,55 @@
+import asyncio
+import heapq
+import itertools
+import random
+
+
+class Backoff:
+    def __init__(self, base=1, cap=300):
+        self._base = base
+        self._cap = cap
+        self._attempt = 0
+
+    def delay(self):
+        # Exponential backoff with full jitter, so connections that failed at
+        # the same moment don't all retry at the same moment too.
+        delay = random.uniform(0, min(self._cap, self._base * 2**self._attempt))
+        self._attempt += 1
+        return delay
+
+    def reset(self):
+        self._attempt = 0
+
+
+class ConnectScheduler:
+    def __init__(self, concurrency):
+        self._available = concurrency
+        # Heap of (priority, sequence, future) waiting for a slot; lowest priority goes first.
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority):
+        if self._available > 0 and not self._waiting:
+            self._available -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # If we were handed a slot just before being cancelled, give it to the next in line.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            # Cancelled waiters are left in the heap; skip them here.
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self._available += 1
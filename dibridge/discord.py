@@ -1,21 +1,95 @@
 import asyncio
+import collections
 import discord
+import functools
+import hashlib
+import json
 import logging
-import re
 import sys
-import textwrap
+import threading
+import time
 
 from . import relay
+from . import tracing
+from .replay_buffer import ReplayBuffer
+from .state import DiscordState
+from .translate import discord_to_irc
+from .webhook_pool import WebhookPool
 
 log = logging.getLogger(__name__)
 
-# The maximum length of a message on IRC. This is different per network,
-# but 400 seems like a safe value for most modern IRC networks.
-IRC_MAX_LINE_LENGTH = 400
+# The maximum length of a message on Discord.
+DISCORD_MAX_MESSAGE_LENGTH = 2000
+# The amount of recent messages to remember the author of, to know who a reply is to.
+RECENT_MESSAGES_MAX = 1000
+
+
+class BridgedChannel:
+    # A Discord channel, and the IRC channel it is bridged with.
+    def __init__(self, channel_id, irc_channel, coalesce_window, send_webhook_func):
+        self._channel_id = channel_id
+        self._irc_channel = irc_channel
+        self._channel = None
+        self._coalesce_window = coalesce_window
+        self._webhook_pool = WebhookPool(send_webhook_func)
+
+        # Lines from a single IRC user waiting to be sent as one message.
+        self._coalesce_username = None
+        self._coalesce_relayed_at = None
+        self._coalesce_trace = None
+        self._coalesce_lines = []
+        self._coalesce_length = 0
+        self._coalesce_timer = None
+
+    def send_message(self, irc_username, message, relayed_at):
+        if not self._coalesce_window:
+            self._webhook_pool.send(irc_username, message, relayed_at)
+            return
+
+        # Only consecutive lines of the same user are merged, and only as
+        # long as they fit in a single Discord message.
+        if (
+            self._coalesce_username != irc_username
+            or self._coalesce_length + 1 + len(message) > DISCORD_MAX_MESSAGE_LENGTH
+        ):
+            self._flush_coalesced()
+
+        if not self._coalesce_lines:
+            self._coalesce_username = irc_username
+            self._coalesce_relayed_at = relayed_at
+            self._coalesce_trace = tracing.current.get()
+            # The first line is not preceded by a newline.
+            self._coalesce_length = -1
+            self._coalesce_timer = asyncio.get_running_loop().call_later(self._coalesce_window, self._flush_coalesced)
+
+        self._coalesce_lines.append(message)
+        self._coalesce_length += 1 + len(message)
+
+    def _flush_coalesced(self):
+        if self._coalesce_timer:
+            self._coalesce_timer.cancel()
+            self._coalesce_timer = None
+        if not self._coalesce_lines:
+            return
+
+        message = "\n".join(self._coalesce_lines)
+        self._coalesce_lines = []
+        # Merged lines are traced as the first line.
+        with tracing.use(self._coalesce_trace):
+            self._webhook_pool.send(self._coalesce_username, message, self._coalesce_relayed_at)
 
 
 class RelayDiscord(discord.Client):
-    def __init__(self, channel_id):
+    def __init__(
+        self,
+        channels,
+        coalesce_window,
+        webhook_pool_size,
+        lean_member_cache,
+        state_file,
+        replay_max_messages,
+        replay_max_age,
+    ):
         # We need many intents:
         # - messages, to receive messages.
         # - guilds, to get the channel.
@@ -26,10 +100,45 @@ class RelayDiscord(discord.Client):
         # Don't allow IRC users to be cheeky, and don't allow @everyone etc.
         allowed_mentions = discord.AllowedMentions.none()
         allowed_mentions.users = True
-        super().__init__(intents=intents, allowed_mentions=allowed_mentions)
+        if lean_member_cache:
+            # Don't download and cache all members of the guild; only those
+            # with an IRC puppet are looked up, as we only need their presence.
+            super().__init__(
+                intents=intents,
+                allowed_mentions=allowed_mentions,
+                chunk_guilds_at_startup=False,
+                member_cache_flags=discord.MemberCacheFlags.none(),
+            )
+        else:
+            super().__init__(intents=intents, allowed_mentions=allowed_mentions)
 
         self._status = None
-        self._channel_id = channel_id
+        self._lean_member_cache = lean_member_cache
+        # Discord IDs of users with an IRC puppet; only their presence is of interest.
+        self._puppeted = set()
+        self._members_to_query = set()
+        self._query_members_task = None
+        # A single Discord session for all channels; messages are routed by channel.
+        self._channels = {
+            channel_id: BridgedChannel(
+                channel_id, irc_channel, coalesce_window, functools.partial(self._send_webhook, channel_id)
+            )
+            for channel_id, irc_channel in channels.items()
+        }
+        self._irc_channels = {bridged._irc_channel: bridged for bridged in self._channels.values()}
+        self._webhook_pool_size = webhook_pool_size
+        self._state = DiscordState(state_file)
+        # Channels of which the stored webhooks are known to still work.
+        self._webhooks_validated = set()
+        # Message ID to (Discord ID, name, IRC username) of its author, from
+        # least to most recently used. Messages relayed from IRC have no
+        # Discord ID.
+        self._recent_messages = collections.OrderedDict()
+        # Messages from IRC while not logged in, to relay once we are. The
+        # lock makes sure no message is buffered after on_ready replayed them.
+        self._replay_buffer = ReplayBuffer(replay_max_messages, replay_max_age)
+        self._replay_lock = threading.Lock()
+        self._relaying = False
         self._commands = discord.app_commands.CommandTree(self)
 
         # Rebind the commands to the current client.
@@ -39,137 +148,218 @@ class RelayDiscord(discord.Client):
         self._commands.add_command(self.command_status)
 
     async def setup_hook(self):
-        # Sync the commands, so Discord knows about them too.
+        # Sync the commands, so Discord knows about them too. Syncing is
+        # heavily rate limited, so only do this when the commands changed.
+        commands = [command.to_dict(self._commands) for command in self._commands.get_commands()]
+        commands_hash = hashlib.sha256(json.dumps([self.application_id, commands], sort_keys=True).encode()).hexdigest()
+        if self._state.get("commands_hash") == commands_hash:
+            return
+
         await self._commands.sync()
+        self._state.set("commands_hash", commands_hash)
 
     async def on_ready(self):
-        # Check if we have access to the channel.
-        self._channel = self.get_channel(self._channel_id)
-        if not self._channel:
-            log.error("Discord channel ID %s not found", self._channel_id)
-            relay.IRC.stop()
-            sys.exit(1)
-
-        # Make sure there is a webhook on the channel to use for relaying.
-        for webhook in await self._channel.webhooks():
-            if webhook.token is not None:
-                self._channel_webhook = webhook
-                break
-        else:
-            self._channel_webhook = await self._channel.create_webhook(
-                name="ircbridge", reason="To bridge IRC messages to Discord"
-            )
+        for bridged in self._channels.values():
+            # Check if we have access to the channel.
+            bridged._channel = self.get_channel(bridged._channel_id)
+            if not bridged._channel:
+                log.error("Discord channel ID %s not found", bridged._channel_id)
+                relay.IRC.stop()
+                sys.exit(1)
+
+            bridged._webhook_pool.set_webhooks(await self._get_webhooks(bridged._channel))
+            # After a reconnect, lines coalesced before it still have their
+            # timer on the event loop of the previous connection.
+            bridged._flush_coalesced()
+
+        with self._replay_lock:
+            messages = self._replay_buffer.take()
+            dropped = self._replay_buffer.dropped
+            self._replay_buffer.dropped = 0
+            self._relaying = True
+        if messages or dropped:
+            log.info("Replaying %d messages to Discord; dropped %d older ones", len(messages), dropped)
+        # In order; the webhooks send one message at a time, as Discord rate limits them.
+        for args in messages:
+            await self._send_message(*args)
 
         if self._status:
             await self._update_presence(self._status)
 
+        # After a reconnect the member cache is empty again.
+        if self._lean_member_cache and self._puppeted:
+            self._members_to_query.update(self._puppeted)
+            self._query_members_later()
+
         log.info("Logged on to Discord as '%s'", self.user)
 
+    async def _get_webhooks(self, channel):
+        # Reuse the webhooks of last time, if they still work; that saves
+        # looking up all webhooks of the channel.
+        key = f"webhooks_{channel.id}"
+        webhooks = [
+            discord.Webhook.partial(webhook_id, token, client=self)
+            for webhook_id, token in (self._state.get(key) or [])[: self._webhook_pool_size]
+        ]
+        if len(webhooks) == self._webhook_pool_size:
+            if channel.id in self._webhooks_validated:
+                return webhooks
+
+            try:
+                fetched = await asyncio.gather(*[webhook.fetch(prefer_auth=False) for webhook in webhooks])
+            except discord.HTTPException:
+                fetched = []
+            if fetched and all(webhook.channel_id == channel.id for webhook in fetched):
+                self._webhooks_validated.add(channel.id)
+                return webhooks
+
+            log.info("Stored webhooks of Discord channel %s no longer work; looking them up again", channel.id)
+
+        # Make sure there are enough webhooks on the channel to use for relaying.
+        webhooks = [webhook for webhook in await channel.webhooks() if webhook.token is not None]
+        webhooks = webhooks[: self._webhook_pool_size]
+        while len(webhooks) < self._webhook_pool_size:
+            webhooks.append(await channel.create_webhook(name="ircbridge", reason="To bridge IRC messages to Discord"))
+
+        self._state.set(key, [[webhook.id, webhook.token] for webhook in webhooks])
+        self._webhooks_validated.add(channel.id)
+        return webhooks
+
     async def on_message(self, message):
-        # Only monitor the indicated channel.
-        if message.channel.id != self._channel_id:
+        relayed_at = time.monotonic()
+
+        # Only monitor the bridged channels.
+        bridged = self._channels.get(message.channel.id)
+        if bridged is None:
             return
+        irc_channel = bridged._irc_channel
         # We don't care what bots have to say.
         if message.author.bot:
             return
         # We don't care if it isn't a message or a reply.
         if message.type not in (discord.MessageType.default, discord.MessageType.reply):
             return
+        tracing.start("discord_to_irc", relayed_at)
 
-        relay.IRC.update_status(message.author.id, message.author.status == discord.Status.offline)
-
-        content = message.content
+        # Without the member cache, the author only has a presence if it was looked up before.
+        if not self._lean_member_cache or message.guild.get_member(message.author.id) is not None:
+            await relay.IRC.update_status(message.author.id, message.author.status == discord.Status.offline)
 
+        reply_author = None
         if message.type == discord.MessageType.reply:
-            author = message.reference.resolved.author
-            content = f"{relay.IRC.get_irc_username(author.id, author.name)}: {content}"
-
-        def replace_mention(prefix, postfix, id, name, content):
-            identifer = f"{prefix}{id}{postfix}"
-
-            # At the beginning of the line, on IRC it is custom to add a ": " behind the highlight.
-            if (
-                content.startswith(f"{identifer}")
-                and not content.startswith(f"{identifer}:")
-                and content != f"{identifer}"
-            ):
-                return f"{name}: " + content[len(f"{identifer}") :].strip()
-
-            # Otherwise it is just an inline replacement.
-            return content.replace(f"{identifer}", name)
-
-        # Replace all mentions in the message with the username (<@12345679>)
-        for mention in message.mentions:
-            content = replace_mention(
-                "<@", ">", mention.id, relay.IRC.get_irc_username(mention.id, mention.name), content
-            )
-        # Replace all channel mentions in the message with the channel name (<#123456789>).
-        for channel in message.channel_mentions:
-            content = replace_mention("<#", ">", channel.id, f"Discord channel #{channel.name}", content)
-        # Replace all role mentions in the message with the role name (<@&123456789>).
-        for role in message.role_mentions:
-            content = replace_mention("<@&", ">", role.id, role.name, content)
-        content = replace_mention("@", "", "everyone", "all", content)
-        content = replace_mention("@", "", "here", "all", content)
-
-        # Replace all emoji mentions in the message with the emoji name (<:emoji:123456789>).
-        # (sadly, discord.py library doesn't have support for it)
-        def find_emojis(content):
-            return [{"id": id, "name": name} for name, id in re.findall(r"<:(\w+):([0-9]{15,20})>", content)]
-
-        for emoji in find_emojis(content):
-            content = replace_mention("<:", ">", f"{emoji['name']}:{emoji['id']}", f":{emoji['name']}:", content)
+            reply_author = self._get_reply_author(message.reference)
+
+        # Look up the IRC username of everyone involved in one go.
+        discord_users = {mention.id: mention.name for mention in message.mentions}
+        discord_users[message.author.id] = message.author.name
+        if reply_author and reply_author[0] is not None:
+            discord_users[reply_author[0]] = reply_author[1]
+        irc_usernames = await relay.IRC.get_irc_usernames(discord_users)
+        tracing.span("usernames")
+
+        self._remember_message(message.id, message.author.id, message.author.name, irc_usernames[message.author.id])
+
+        content = message.content
+        if reply_author:
+            if reply_author[0] is None:
+                content = f"{reply_author[2]}: {content}"
+            else:
+                content = f"{irc_usernames[reply_author[0]]}: {content}"
+
+        is_action, lines = discord_to_irc(
+            content,
+            {mention.id: irc_usernames[mention.id] for mention in message.mentions},
+            {channel.id: channel.name for channel in message.channel_mentions},
+            {role.id: role.name for role in message.role_mentions},
+        )
 
         # First, send any attachment as links.
         for attachment in message.attachments:
-            relay.IRC.send_message(message.author.id, message.author.name, attachment.url)
-
-        content = content.replace("\r\n", "\n").replace("\r", "\n").strip()
+            await relay.IRC.send_message(
+                irc_channel, message.author.id, message.author.name, attachment.url, relayed_at
+            )
 
-        # On Discord text between _ and _ is what IRC calls an action.
-        # IRC has a limit on message size; if reached, make the action multi-line too.
-        if (
-            content.startswith("_")
-            and content.endswith("_")
-            and len(content) > 2
-            and "\n" not in content
-            and len(content) < IRC_MAX_LINE_LENGTH
-        ):
-            relay.IRC.send_action(message.author.id, message.author.name, content[1:-1])
+        if is_action:
+            await relay.IRC.send_action(irc_channel, message.author.id, message.author.name, lines[0], relayed_at)
         else:
-            for full_line in content.split("\n"):
-                # On Discord, you make code-blocks by starting and finishing with ```.
-                # This is considered noise on IRC however. So we ignore those lines.
-                if full_line == "```":
-                    continue
+            for line in lines:
+                await relay.IRC.send_message(irc_channel, message.author.id, message.author.name, line, relayed_at)
+
+    def _remember_message(self, message_id, author_id, author_name, irc_username):
+        self._recent_messages[message_id] = (author_id, author_name, irc_username)
+        if len(self._recent_messages) > RECENT_MESSAGES_MAX:
+            self._recent_messages.popitem(last=False)
+
+    def _get_reply_author(self, reference):
+        # Without a network call, find out who is replied to. The IRC
+        # username is looked up again, as it might have changed since.
+        if reference.message_id in self._recent_messages:
+            self._recent_messages.move_to_end(reference.message_id)
+            return self._recent_messages[reference.message_id]
 
-                # Split the message in lines of at most IRC_MAX_LINE_LENGTH characters, breaking on words.
-                for line in textwrap.wrap(full_line.strip(), IRC_MAX_LINE_LENGTH):
-                    relay.IRC.send_message(message.author.id, message.author.name, line)
+        # Not one of ours; maybe discord.py still knows about it.
+        if isinstance(reference.resolved, discord.Message):
+            author = reference.resolved.author
+            return (author.id, author.name, None)
+
+        # The message is deleted, or too old to know about.
+        return None
 
     async def on_presence_update(self, before, after):
-        relay.IRC.update_status(after.id, after.status == discord.Status.offline)
+        if after.id not in self._puppeted:
+            return
+
+        await relay.IRC.update_status(after.id, after.status == discord.Status.offline)
 
     async def on_error(self, event, *args, **kwargs):
         log.exception("on_error(%s): %r / %r", event, args, kwargs)
 
     @discord.app_commands.command(name="status", description="Get the status of the bridge")
     async def command_status(self, interaction: discord.Interaction):
-        status = f":green_circle: **Discord** listening in <#{self._channel_id}>\n"
-        status += relay.IRC.get_status()
+        channels = ", ".join(f"<#{channel_id}>" for channel_id in self._channels)
+        status = f":green_circle: **Discord** listening in {channels}\n"
+        status += await relay.IRC.get_status()
 
         await interaction.response.send_message(status, ephemeral=True)
 
-    async def _send_message(self, irc_username, message):
-        await self._channel_webhook.send(
-            message,
-            username=irc_username,
-            suppress_embeds=True,
-            avatar_url=f"https://robohash.org/${irc_username}.png?set=set4",
-        )
+    async def _send_message(self, irc_channel, irc_username, message, relayed_at):
+        tracing.span("discord_loop")
+        self._irc_channels[irc_channel].send_message(irc_username, message, relayed_at)
 
-    async def _send_message_self(self, message):
-        await self._channel.send(message)
+    async def _send_webhook(self, channel_id, webhook, irc_username, message):
+        # Wait for the message, to know its ID; there is a response either way.
+        try:
+            sent = await webhook.send(
+                message,
+                username=irc_username,
+                suppress_embeds=True,
+                avatar_url=f"https://robohash.org/${irc_username}.png?set=set4",
+                wait=True,
+            )
+        except discord.NotFound:
+            await self._replace_webhooks(channel_id)
+            raise
+        self._remember_message(sent.id, None, irc_username, irc_username)
+
+    async def _replace_webhooks(self, channel_id):
+        # The webhook was deleted; forget the stored ones, and look them up
+        # again, so the next messages are relayed. When more webhooks of the
+        # channel fail at the same time, this is only done once.
+        if channel_id not in self._webhooks_validated:
+            return
+        self._webhooks_validated.discard(channel_id)
+        self._state.delete(f"webhooks_{channel_id}")
+
+        bridged = self._channels[channel_id]
+        if not self.is_ready() or bridged._channel is None:
+            # on_ready looks them up.
+            return
+
+        log.info("Webhook of Discord channel %s was deleted; looking them up again", channel_id)
+        bridged._webhook_pool.set_webhooks(await self._get_webhooks(bridged._channel))
+
+    async def _send_message_self(self, irc_channel, message):
+        await self._irc_channels[irc_channel]._channel.send(message)
 
     async def _update_presence(self, status):
         self._status = status
@@ -178,35 +368,129 @@ class RelayDiscord(discord.Client):
             status=discord.Status.online,
         )
 
+    def _query_members_later(self):
+        # A task cancelled with the event loop of a previous connection is done too.
+        if self._query_members_task is None or self._query_members_task.done():
+            self._query_members_task = asyncio.create_task(self._query_members())
+
+    async def _query_members(self):
+        # Wait a moment, so puppets created together (like when they are
+        # restored) are looked up together.
+        await asyncio.sleep(1)
+        user_ids = list(self._members_to_query)
+        self._members_to_query.clear()
+        self._query_members_task = None
+
+        guilds = {bridged._channel.guild for bridged in self._channels.values() if bridged._channel}
+        for guild in guilds:
+            # Discord allows looking up 100 members per request.
+            for i in range(0, len(user_ids), 100):
+                members = await guild.query_members(user_ids=user_ids[i : i + 100], presences=True, cache=True)
+                for member in members:
+                    await relay.IRC.update_status(member.id, member.status == discord.Status.offline)
+
+    async def _add_puppet(self, discord_id):
+        if not self._lean_member_cache:
+            return
+
+        # Cache the member, as otherwise its presence updates are discarded.
+        self._members_to_query.add(discord_id)
+        self._query_members_later()
+
+    async def _remove_puppet(self, discord_id):
+        if not self._lean_member_cache:
+            return
+
+        self._members_to_query.discard(discord_id)
+        for bridged in self._channels.values():
+            if bridged._channel:
+                bridged._channel.guild._remove_member(discord.Object(discord_id))
+
     async def _stop(self):
         sys.exit(1)
 
+    async def _reload(self, coalesce_window):
+        for bridged in self._channels.values():
+            bridged._coalesce_window = coalesce_window
+            if not coalesce_window:
+                bridged._flush_coalesced()
+
+    def clear(self):
+        # Until the next on_ready, buffer messages from IRC again.
+        with self._replay_lock:
+            self._relaying = False
+        super().clear()
+
     # Thread safe wrapper around functions
 
-    def send_message(self, irc_username, message):
-        if self.loop == discord.utils.MISSING:
-            log.warning(f"Can't relay message from {irc_username} to Discord: connection is down.")
-            return
+    def send_message(self, irc_channel, irc_username, message, relayed_at):
+        with self._replay_lock:
+            if not self._relaying:
+                tracing.span("buffered")
+                self._replay_buffer.put(irc_channel, irc_username, message, relayed_at)
+                return
 
-        asyncio.run_coroutine_threadsafe(self._send_message(irc_username, message), self.loop)
+            relay.schedule(self._send_message(irc_channel, irc_username, message, relayed_at), self.loop)
 
-    def send_message_self(self, message):
+    def send_message_self(self, irc_channel, message):
         if self.loop == discord.utils.MISSING:
             log.warning("Can't relay status message to Discord: connection is down.")
             return
 
-        asyncio.run_coroutine_threadsafe(self._send_message_self(message), self.loop)
+        relay.schedule(self._send_message_self(irc_channel, message), self.loop)
+
+    def reload(self, coalesce_window):
+        if not self.is_ready():
+            # Nothing is being coalesced while not logged in.
+            for bridged in self._channels.values():
+                bridged._coalesce_window = coalesce_window
+            return
+
+        relay.schedule(self._reload(coalesce_window), self.loop)
+
+    def add_puppet(self, discord_id):
+        # The set is updated directly, so it is also correct for puppets
+        # created while not logged in; on_ready looks those up.
+        self._puppeted.add(discord_id)
+        if not self.is_ready():
+            return
+
+        relay.schedule(self._add_puppet(discord_id), self.loop)
+
+    def remove_puppet(self, discord_id):
+        self._puppeted.discard(discord_id)
+        if not self.is_ready():
+            return
+
+        relay.schedule(self._remove_puppet(discord_id), self.loop)
 
     def update_presence(self, status):
         if self.loop == discord.utils.MISSING:
             log.warning(f"Can't update presence to {status}: connection is down.")
             return
 
-        asyncio.run_coroutine_threadsafe(self._update_presence(status), self.loop)
-
-
-def start(token, channel_id):
-    relay.DISCORD = RelayDiscord(channel_id)
+        relay.schedule(self._update_presence(status), self.loop)
+
+
+def start(
+    token,
+    channels,
+    coalesce_window,
+    webhook_pool_size,
+    lean_member_cache,
+    state_file,
+    replay_max_messages,
+    replay_max_age,
+):
+    relay.DISCORD = RelayDiscord(
+        channels,
+        coalesce_window,
+        webhook_pool_size,
+        lean_member_cache,
+        state_file,
+        replay_max_messages,
+        replay_max_age,
+    )
     backoff = discord.backoff.ExponentialBackoff()
 
     while True:
@@ -217,3 +501,41 @@ def start(token, channel_id):
             log.exception("Discord client stopped unexpectedly; will reconnect in %.2f seconds", retry)
 
             asyncio.run(asyncio.sleep(retry))
+
+        # Reset the internal state, as otherwise the client considers itself closed.
+        relay.DISCORD.clear()
+
+
+async def run(
+    token,
+    channels,
+    coalesce_window,
+    webhook_pool_size,
+    lean_member_cache,
+    state_file,
+    replay_max_messages,
+    replay_max_age,
+):
+    # Like start(), but on an event loop shared with IRC.
+    relay.DISCORD = RelayDiscord(
+        channels,
+        coalesce_window,
+        webhook_pool_size,
+        lean_member_cache,
+        state_file,
+        replay_max_messages,
+        replay_max_age,
+    )
+    backoff = discord.backoff.ExponentialBackoff()
+
+    while True:
+        try:
+            async with relay.DISCORD:
+                await relay.DISCORD.start(token)
+        except Exception:
+            retry = backoff.delay()
+            log.exception("Discord client stopped unexpectedly; will reconnect in %.2f seconds", retry)
+
+            await asyncio.sleep(retry)
+
+        relay.DISCORD.clear()
@@ -0,0 +1,38 @@
+import collections
+import time
+
+
+class ExpiringSet:
+    # Remembers keys for a limited time, and never more than max_size keys.
+    # Keys are kept ordered from least to most recently added, so expired
+    # (or excess) keys are always at the front, and removing them is
+    # amortised O(1) per key added.
+    def __init__(self, timeout, max_size):
+        self._timeout = timeout
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        self._expire()
+        return len(self._entries)
+
+    def add(self, key):
+        self._entries[key] = time.monotonic()
+        self._entries.move_to_end(key)
+
+        self._expire()
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        # Returns whether the key was added recently, and forgets about it.
+        self._expire()
+        return self._entries.pop(key, None) is not None
+
+    def _expire(self):
+        expire_before = time.monotonic() - self._timeout
+        while self._entries:
+            added_at = next(iter(self._entries.values()))
+            if added_at > expire_before:
+                break
+            self._entries.popitem(last=False)
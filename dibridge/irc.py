@@ -1,7 +1,9 @@
 import asyncio
+import collections
 import irc.client_aio
 import functools
 import hashlib
+import ipaddress
 import logging
 import re
 import sys
@@ -9,14 +11,27 @@ import time
 
 from openttd_helpers.asyncio_helper import enable_strong_referenced_tasks
 
+from . import metrics
+from .connect_scheduler import ConnectScheduler
+from .expiring_set import ExpiringSet
 from .irc_puppet import IRCPuppet
+from .irc_puppet import PuppetReactor
+from .puppet_worker import PuppetProxy
+from .puppet_worker import PuppetWorker
+from .replay_buffer import ReplayBuffer
+from .resolver import get_resolver
+from .send_queue import SendQueue
+from .state import PuppetState
+from .timer_wheel import TimerWheel
 from . import relay
+from . import tracing
 
 log = logging.getLogger(__name__)
 
 # When a user on IRC was talking but left within 10 minutes, announce
 # this on Discord. This to prevent Discord users thinking they can still
-# talk to someone if they are in an active conversation with them.
+# talk to someone if they are in an active conversation with them. And
+# when they come back within 10 minutes, announce that too.
 LEFT_WHILE_TALKING_TIMEOUT = 60 * 10
 
 # By RFC, only these characters are allowed in a nickname.
@@ -26,10 +41,31 @@ REGEX_NICKNAME_START_FILTER = r"^[0-9\-]+"
 # By implementation, a username is more strict than a nickname in what
 # it can start with. This filter is in addition to the nickname filters.
 REGEX_USERNAME_START_FILTER = r"^[_\[\]\{\}\|]+"
+# A Discord highlight followed by ": ", as often done on IRC when addressing someone.
+REGEX_HIGHLIGHT_COLON = re.compile(r"<@([0-9]+)>: ")
 
 
 class IRCRelay(irc.client_aio.AioSimpleIRCClient):
-    def __init__(self, host, port, nickname, channel, puppet_ip_range, puppet_postfix, ignore_list, idle_timeout):
+    def __init__(
+        self,
+        host,
+        port,
+        nickname,
+        channels,
+        puppet_ip_range,
+        puppet_postfix,
+        ignore_list,
+        idle_timeout,
+        flood_rate,
+        flood_burst,
+        connect_concurrency,
+        state_file,
+        max_puppets,
+        recently_spoken_max,
+        puppet_workers,
+        replay_max_messages,
+        replay_max_age,
+    ):
         irc.client.SimpleIRCClient.__init__(self)
 
         self._loop = asyncio.get_event_loop()
@@ -39,21 +75,69 @@ class IRCRelay(irc.client_aio.AioSimpleIRCClient):
         self._nickname = nickname
         self._nickname_original = nickname
         self._nickname_iteration = 0
-        self._joined = False
-        self._tell_once = True
-        self._channel = channel
+        self._joined_channels = set()
+        self._joined_event = asyncio.Event()
+        # Channels we told Discord about the bridge not being active.
+        self._told_inactive = set()
+        self._channels = channels
+        # Messages from Discord while a channel is not joined, to relay once it is.
+        self._replay_max_messages = replay_max_messages
+        self._replay_buffers = {channel: ReplayBuffer(replay_max_messages, replay_max_age) for channel in channels}
         self._puppet_ip_range = puppet_ip_range
         self._puppet_postfix = puppet_postfix
-        self._pinger_task = None
+        self._pinger = None
         self._ignore_list = ignore_list
         self._idle_timeout = idle_timeout
-
-        # List of users when they have last spoken.
-        self._users_spoken = {}
-
-        self._puppets = {}
+        self._flood_rate = flood_rate
+        self._flood_burst = flood_burst
+
+        self._send_queue = SendQueue(self._joined_event, flood_rate, flood_burst)
+        self._connect_scheduler = ConnectScheduler(connect_concurrency)
+        # Drives the keep-alive pings and idle timeouts of the relay and all puppets.
+        self._timer_wheel = TimerWheel()
+        # All puppets in this process share a single reactor.
+        self._puppet_reactor = PuppetReactor()
+        self._resolver = get_resolver(host)
+        # Optionally, puppets live in worker processes; the connect concurrency is split over them.
+        self._puppet_workers = [
+            PuppetWorker(
+                index,
+                host,
+                port,
+                idle_timeout,
+                flood_rate,
+                flood_burst,
+                max(1, connect_concurrency // puppet_workers),
+            )
+            for index in range(puppet_workers)
+        ]
+        # Without puppets, there is no state worth remembering.
+        self._state = PuppetState(state_file) if state_file and puppet_ip_range else None
+        self._state_restored = False
+
+        # Users (per channel) who have spoken recently, and users who left
+        # while they were talking. Both forget users after a while, and are
+        # capped in size, so they don't grow in a busy channel.
+        self._users_spoken = ExpiringSet(LEFT_WHILE_TALKING_TIMEOUT, recently_spoken_max)
+        self._users_left = ExpiringSet(LEFT_WHILE_TALKING_TIMEOUT, recently_spoken_max)
+
+        # Puppets ordered from least to most recently active.
+        self._puppets = collections.OrderedDict()
+        self._max_puppets = max_puppets
+        self._puppet_evictions = 0
+
+        metrics.IRC_PUPPETS.set_function(self.get_puppet_states)
+        # Index of puppet nicknames to Discord IDs. Normally there is only a
+        # single Discord ID per nickname, but while a nickname collision is
+        # being resolved, two puppets can briefly share the same nickname.
+        self._puppet_nicknames = {}
+        # Single regex matching any puppet nickname; rebuilt lazily when the
+        # index changes.
+        self._puppet_nicknames_regex = None
 
     def on_nicknameinuse(self, client, event):
+        metrics.IRC_NICKNAME_COLLISIONS.inc()
+
         # Nickname is already in use, start adding numbers at the end to fix that.
         self._nickname_iteration += 1
         self._nickname = f"{self._nickname_original}[{self._nickname_iteration}]"
@@ -61,163 +145,336 @@ class IRCRelay(irc.client_aio.AioSimpleIRCClient):
 
     def on_welcome(self, client, event):
         self._client = client
-        self._client.join(self._channel)
+        for channel in self._channels:
+            self._client.join(channel)
 
-        if self._pinger_task:
-            self._pinger_task.cancel()
-        self._pinger_task = asyncio.create_task(self._pinger())
+        if self._pinger:
+            self._pinger.cancel()
+        self._pinger = self._timer_wheel.call_every(120, self._ping)
 
     def on_privmsg(self, _, event):
         # TODO -- Consider relaying private messages too. Can be useful to identify with NickServ etc.
         pass
 
     def on_pubmsg(self, _, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
         if event.source.nick.lower() in self._ignore_list:
             return
-        asyncio.create_task(self._relay_mesage(event.source.nick, event.arguments[0]))
+        asyncio.create_task(self._relay_mesage(event.target, event.source.nick, event.arguments[0], time.monotonic()))
 
     def on_action(self, _, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
-        asyncio.create_task(self._relay_mesage(event.source.nick, f"_{event.arguments[0]}_"))
+        asyncio.create_task(
+            self._relay_mesage(event.target, event.source.nick, f"_{event.arguments[0]}_", time.monotonic())
+        )
 
     def on_join(self, _client, event):
-        if event.target != self._channel:
+        channel = event.target
+        if channel not in self._channels:
             return
 
         if event.source.nick == self._nickname:
-            if not self._tell_once:
-                relay.DISCORD.send_message_self(":white_check_mark: IRC bridge is now active :white_check_mark: ")
-            log.info("Joined %s on IRC", self._channel)
-            self._joined = True
-            self._tell_once = True
+            if channel in self._told_inactive:
+                self._told_inactive.discard(channel)
+                relay.DISCORD.send_message_self(
+                    channel, ":white_check_mark: IRC bridge is now active :white_check_mark: "
+                )
+            log.info("Joined %s on IRC", channel)
+            self._joined_channels.add(channel)
+            self._joined_event.set()
+            asyncio.create_task(self._replay(channel))
 
-            relay.DISCORD.update_presence(f"{self._channel} on IRC")
+            relay.DISCORD.update_presence(f"{', '.join(sorted(self._joined_channels))} on IRC")
+
+            if self._state and not self._state_restored:
+                self._state_restored = True
+                self._restore_puppets()
+            return
+
+        # If the user left while talking, show on Discord the user is back.
+        if self._users_left.pop((channel, event.source.nick)):
+            relay.DISCORD.send_message(channel, event.source.nick, "_rejoined the IRC channel_", time.monotonic())
 
     def on_part(self, _client, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
-        self._left(event.source.nick)
+        self._left(event.target, event.source.nick)
 
     def on_kick(self, _client, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
-        self._left(event.arguments[0])
+        self._left(event.target, event.arguments[0])
 
     def on_quit(self, _client, event):
-        self._left(event.source.nick)
+        # Quitting is leaving every channel at once.
+        for channel in self._channels:
+            self._left(channel, event.source.nick)
 
     def on_disconnect(self, _client, event):
         log.error("Disconnected from IRC")
-        self._joined = False
-        if self._pinger_task:
-            self._pinger_task.cancel()
+        self._joined_channels.clear()
+        self._joined_event.clear()
+        if self._pinger:
+            self._pinger.cancel()
+            self._pinger = None
 
+        metrics.IRC_RECONNECTS.inc()
         # Start a task to reconnect us.
         asyncio.create_task(self._connect())
 
-    def _left(self, nick):
+    def _left(self, channel, nick):
         # If we left the channel, rejoin.
         if nick == self._nickname:
-            self._joined = False
-            self._client.join(self._channel)
+            self._joined_channels.discard(channel)
+            self._client.join(channel)
             return
 
         # If the user spoken recently, show on Discord the user left.
-        if self._users_spoken.get(nick, 0) > time.time() - LEFT_WHILE_TALKING_TIMEOUT:
-            self._users_spoken.pop(nick)
-            relay.DISCORD.send_message(nick, "_left the IRC channel_")
+        if self._users_spoken.pop((channel, nick)):
+            self._users_left.add((channel, nick))
+            relay.DISCORD.send_message(channel, nick, "_left the IRC channel_", time.monotonic())
+
+    def _ping(self):
+        self._client.ping("keep-alive")
+
+    async def _replay(self, channel):
+        # Relay what was said on Discord while the channel was not joined,
+        # in order; the send queues of the relay and puppets rate limit it.
+        replay_buffer = self._replay_buffers[channel]
+        messages = replay_buffer.take()
+        if messages or replay_buffer.dropped:
+            log.info(
+                "Replaying %d messages to %s on IRC; dropped %d older ones",
+                len(messages),
+                channel,
+                replay_buffer.dropped,
+            )
+            replay_buffer.dropped = 0
 
-    async def _pinger(self):
-        while True:
-            await asyncio.sleep(120)
-            self._client.ping("keep-alive")
+        for args in messages:
+            await self._send_message(*args)
 
     async def _connect(self):
         while True:
             # Additional constraints usernames have over nicknames.
             username = re.sub(REGEX_USERNAME_START_FILTER, "", self._nickname)
 
+            host_ip = await self._resolver.resolve()
+            if host_ip is None:
+                log.warning("Failed DNS lookup, retrying in 5 seconds")
+                # When we can't connect, try again in 5 seconds.
+                await asyncio.sleep(5)
+                continue
+
+            use_ssl = self._port == 6697
             try:
                 await self.connection.connect(
-                    self._host,
+                    host_ip,
                     self._port,
                     self._nickname,
                     username=username,
-                    connect_factory=irc.connection.AioFactory(ssl=self._port == 6697),
+                    connect_factory=irc.connection.AioFactory(
+                        ssl=use_ssl,
+                        server_hostname=self._host if use_ssl else None,
+                    ),
                 )
+                self._resolver.report_success(host_ip)
                 break
-            except ConnectionRefusedError:
-                log.warning("Connection refused, retrying in 5 seconds")
+            except OSError as e:
+                self._resolver.report_failure(host_ip)
+                log.warning("Connection failed (%s), retrying in 5 seconds", e)
                 # When we can't connect, try again in 5 seconds.
                 await asyncio.sleep(5)
 
-    async def _send_message(self, discord_id, discord_username, message, is_action=False):
+    async def _send_message(self, channel, discord_id, discord_username, message, relayed_at, is_action=False):
+        tracing.span("irc_loop")
+
         # If we aren't connected to IRC yet, tell this to the Discord users; but only once.
-        if not self._joined:
-            if self._tell_once:
-                self._tell_once = False
-                relay.DISCORD.send_message_self(
-                    ":warning: IRC bridge isn't active; messages will not be delivered :warning:"
-                )
+        if channel not in self._joined_channels:
+            if channel not in self._told_inactive:
+                self._told_inactive.add(channel)
+                if self._replay_max_messages:
+                    notice = ":warning: IRC bridge isn't active; messages will be delivered once it is back :warning:"
+                else:
+                    notice = ":warning: IRC bridge isn't active; messages will not be delivered :warning:"
+                relay.DISCORD.send_message_self(channel, notice)
+
+            tracing.span("buffered")
+            self._replay_buffers[channel].put(channel, discord_id, discord_username, message, relayed_at, is_action)
             return
 
         if not self._puppet_ip_range:
             if is_action:
                 message = f"/me {message}"
-            self._client.privmsg(self._channel, f"<{discord_username}>: {message}")
+            self._send_queue.put(relayed_at, self.connection.privmsg, channel, f"<{discord_username}>: {message}")
             return
 
         if discord_id not in self._puppets:
-            sanitized_discord_username = self._sanitize_discord_username(discord_username)
+            if self._max_puppets and len(self._puppets) >= self._max_puppets:
+                await self._evict_puppet()
+
+            puppet = self._create_puppet(discord_id, discord_username, [channel])
+            if self._state:
+                self._state.store_puppet(
+                    discord_id, discord_username, puppet._nickname, puppet._ipv6_address, time.time(), [channel]
+                )
+        else:
+            puppet = self._puppets[discord_id]
+            self._puppets.move_to_end(discord_id)
+
+            # A single connection per user; it joins every channel the user talks in.
+            if channel not in puppet._channels:
+                puppet.join_channel(channel)
+                if self._state:
+                    self._state.update_channels(discord_id, puppet._channels)
+            if self._state:
+                self._state.update_last_spoke(discord_id, time.time())
+
+        if is_action:
+            await puppet.send_action(channel, message, relayed_at)
+        else:
+            await puppet.send_message(channel, message, relayed_at)
+
+    def _create_puppet(self, discord_id, discord_username, channels, ipv6_address=None):
+        sanitized_discord_username = self._sanitize_discord_username(discord_username)
+        if ipv6_address is None:
             ipv6_address = self._puppet_ip_range[self._generate_ipv6_bits(sanitized_discord_username)]
 
-            irc_nickname = f"{sanitized_discord_username}{self._puppet_postfix}"
-            irc_username = re.sub(REGEX_USERNAME_START_FILTER, "", irc_nickname)
+        irc_nickname = f"{sanitized_discord_username}{self._puppet_postfix}"
+        irc_username = re.sub(REGEX_USERNAME_START_FILTER, "", irc_nickname)
 
-            self._puppets[discord_id] = IRCPuppet(
+        if self._puppet_workers:
+            # Partition the puppets by Discord ID, so a user always ends up on the same worker.
+            puppet = PuppetProxy(
+                self._puppet_workers[discord_id % len(self._puppet_workers)],
+                discord_id,
+                ipv6_address,
+                irc_nickname,
+                irc_username,
+                channels,
+                functools.partial(self._remove_puppet, discord_id),
+                functools.partial(self._update_puppet_nickname, discord_id),
+            )
+        else:
+            puppet = IRCPuppet(
                 self._host,
                 self._port,
                 ipv6_address,
                 irc_nickname,
                 irc_username,
-                self._channel,
+                channels,
                 functools.partial(self._remove_puppet, discord_id),
+                functools.partial(self._update_puppet_nickname, discord_id),
                 self._idle_timeout,
+                self._flood_rate,
+                self._flood_burst,
+                self._connect_scheduler,
+                self._timer_wheel,
+                self._puppet_reactor,
             )
-            asyncio.create_task(self._puppets[discord_id].connect())
+        self._puppets[discord_id] = puppet
+        self._add_puppet_nickname(discord_id, irc_nickname)
+        relay.DISCORD.add_puppet(discord_id)
+        asyncio.create_task(puppet.connect())
+        return puppet
+
+    def _restore_puppets(self):
+        # Reconnect the puppets of users that were active before the bridge
+        # restarted, so their next message doesn't wait for a new connection.
+        puppets = []
+        for puppet in self._state.get_puppets(time.time() - self._idle_timeout):
+            # Only rejoin the channels that are still bridged.
+            channels = [channel for channel in puppet[-1] if channel in self._channels]
+            if channels:
+                puppets.append(puppet[:-1] + (channels,))
+        if self._max_puppets:
+            puppets = puppets[: self._max_puppets - len(self._puppets)]
+
+        # Least recently active first, as that is the order of the puppets.
+        for discord_id, discord_username, nickname, ipv6_address, last_spoke, is_offline, channels in reversed(puppets):
+            if discord_id in self._puppets:
+                continue
+
+            ipv6_address = ipaddress.ip_address(ipv6_address)
+            # If the IP range changed since, we need a new IPv6 address.
+            if ipv6_address not in self._puppet_ip_range:
+                ipv6_address = None
+
+            log.info("Restoring IRC puppet for %s (last known as %s)", discord_username, nickname)
+            puppet = self._create_puppet(discord_id, discord_username, channels, ipv6_address)
+            puppet._last_spoke = last_spoke
+            if is_offline:
+                asyncio.create_task(puppet.start_idle_timeout())
+
+    async def _evict_puppet(self):
+        # Make room for a new puppet by closing the connection of the user
+        # that has been quiet the longest.
+        discord_id, puppet = next(iter(self._puppets.items()))
+        puppet._log.info("Too many IRC connections; removing puppet of least active user")
+
+        self._puppet_evictions += 1
+        await puppet.stop_idle_timeout()
+        await puppet.disconnect("Too many users active on Discord")
+        await self._remove_puppet(discord_id)
+
+    async def _relay_mesage(self, channel, irc_username, message, relayed_at):
+        # Don't echo back talk done by our puppets.
+        if irc_username in self._puppet_nicknames:
+            return
+        tracing.start("irc_to_discord", relayed_at)
 
-        if is_action:
-            await self._puppets[discord_id].send_action(message)
-        else:
-            await self._puppets[discord_id].send_message(message)
-
-    async def _relay_mesage(self, irc_username, message):
-        for discord_id, puppet in self._puppets.items():
-            # Don't echo back talk done by our puppets.
-            if puppet._nickname == irc_username:
-                return
-
-            # If the username is said as its own word, replace it with a Discord highlight.
-            message = " ".join(
-                [
-                    (
-                        re.sub(r"(?<!\w)" + re.escape(puppet._nickname) + r"(?!\w)", f"<@{discord_id}>", part)
-                        if "://" not in part
-                        else part
-                    )
-                    for part in message.split(" ")
-                ]
-            )
+        if self._puppet_nicknames:
+            # If a puppet nickname is said as its own word, replace it with a Discord highlight.
+            message = self._get_puppet_nicknames_regex().sub(self._replace_highlight, message)
 
             # On IRC, it is common to do "name: ", but on Discord you don't do that ": " part.
-            if message.startswith(f"<@{discord_id}>: "):
-                message = f"<@{discord_id}> " + message[len(f"<@{discord_id}>: ") :]
+            match = REGEX_HIGHLIGHT_COLON.match(message)
+            if match and int(match.group(1)) in self._puppets:
+                message = f"<@{match.group(1)}> " + message[match.end() :]
+
+        self._users_spoken.add((channel, irc_username))
+        relay.DISCORD.send_message(channel, irc_username, message, relayed_at)
+
+    def _get_puppet_nicknames_regex(self):
+        if self._puppet_nicknames_regex is None:
+            # Longest nicknames first, so "name[d]" wins from "name".
+            nicknames = sorted(self._puppet_nicknames, key=len, reverse=True)
+            # Words containing "://" are most likely URLs; those are matched
+            # as a whole, so they can be left alone by _replace_highlight.
+            self._puppet_nicknames_regex = re.compile(
+                r"(?P<url>(?<![^ ])[^ ]*://[^ ]*)|(?<!\w)(?P<nickname>"
+                + "|".join(re.escape(nickname) for nickname in nicknames)
+                + r")(?!\w)"
+            )
+        return self._puppet_nicknames_regex
+
+    def _replace_highlight(self, match):
+        if match.lastgroup == "url":
+            return match.group(0)
+        return f"<@{self._puppet_nicknames[match.group(0)][0]}>"
+
+    def _add_puppet_nickname(self, discord_id, nickname):
+        self._puppet_nicknames.setdefault(nickname, []).append(discord_id)
+        self._puppet_nicknames_regex = None
+
+    def _remove_puppet_nickname(self, discord_id, nickname):
+        discord_ids = self._puppet_nicknames.get(nickname)
+        if discord_ids is None or discord_id not in discord_ids:
+            return
+
+        discord_ids.remove(discord_id)
+        if not discord_ids:
+            del self._puppet_nicknames[nickname]
+        self._puppet_nicknames_regex = None
+
+    def _update_puppet_nickname(self, discord_id, old_nickname, new_nickname):
+        self._remove_puppet_nickname(discord_id, old_nickname)
+        self._add_puppet_nickname(discord_id, new_nickname)
 
-        self._users_spoken[irc_username] = time.time()
-        relay.DISCORD.send_message(irc_username, message)
+        if self._state:
+            self._state.update_nickname(discord_id, new_nickname)
 
     def _sanitize_discord_username(self, discord_username):
         original_discord_username = discord_username
@@ -257,28 +514,40 @@ class IRCRelay(irc.client_aio.AioSimpleIRCClient):
         sys.exit(1)
 
     async def _remove_puppet(self, discord_id):
-        self._puppets.pop(discord_id)
+        puppet = self._puppets.pop(discord_id)
+        self._remove_puppet_nickname(discord_id, puppet._nickname)
+        relay.DISCORD.remove_puppet(discord_id)
 
-    # Thread safe wrapper around functions
+        if self._state:
+            self._state.remove_puppet(discord_id)
 
-    def get_status(self):
-        if self._joined:
-            status = f":green_circle: **IRC** listening on `{self._host}` in `{self._channel}`\n"
+    async def _get_status(self):
+        if self._joined_channels:
+            channels = ", ".join(f"`{channel}`" for channel in sorted(self._joined_channels))
+            status = f":green_circle: **IRC** listening on `{self._host}` in {channels}\n"
         else:
             status = ":red_circle: **IRC** not connected\n"
         if self._puppets:
             joined = len([True for puppet in self._puppets.values() if puppet._joined])
             status += "\n"
             status += f"**{len(self._puppets)}** IRC connections, **{joined}** connected\n"
+        if self._puppet_evictions:
+            status += (
+                f"**{self._puppet_evictions}** IRC connections closed to stay within the limit of "
+                f"**{self._max_puppets}**\n"
+            )
         return status
 
-    def get_irc_username(self, discord_id, discord_username):
-        if discord_id not in self._puppets:
-            return self._sanitize_discord_username(discord_username)
-
-        return self._puppets[discord_id]._nickname
+    async def _get_irc_usernames(self, discord_users):
+        irc_usernames = {}
+        for discord_id, discord_username in discord_users.items():
+            if discord_id in self._puppets:
+                irc_usernames[discord_id] = self._puppets[discord_id]._nickname
+            else:
+                irc_usernames[discord_id] = self._sanitize_discord_username(discord_username)
+        return irc_usernames
 
-    def update_status(self, discord_id, is_offline):
+    async def _update_status(self, discord_id, is_offline):
         if discord_id not in self._puppets:
             return
 
@@ -287,29 +556,128 @@ class IRCRelay(irc.client_aio.AioSimpleIRCClient):
 
         if is_offline:
             # Start a timer to delete the puppet after timeout.
-            asyncio.run_coroutine_threadsafe(self._puppets[discord_id].start_idle_timeout(), self._loop)
+            await self._puppets[discord_id].start_idle_timeout()
         else:
             # Stop the timer if the user comes back.
-            asyncio.run_coroutine_threadsafe(self._puppets[discord_id].stop_idle_timeout(), self._loop)
+            await self._puppets[discord_id].stop_idle_timeout()
 
-    def send_message(self, discord_id, discord_username, message):
-        asyncio.run_coroutine_threadsafe(self._send_message(discord_id, discord_username, message), self._loop)
+        if self._state:
+            self._state.update_offline(discord_id, is_offline)
+
+    async def _reload(self, ignore_list, puppet_postfix, idle_timeout):
+        self._ignore_list = ignore_list
+
+        # Running idle timeouts keep their deadline; the new timeout is used
+        # the next time a user goes offline.
+        self._idle_timeout = idle_timeout
+        for worker in self._puppet_workers:
+            worker.send("reload", idle_timeout=idle_timeout)
+        for puppet in self._puppets.values():
+            if not isinstance(puppet, PuppetProxy):
+                puppet._idle_timeout = idle_timeout
 
-    def send_action(self, discord_id, discord_username, message):
-        asyncio.run_coroutine_threadsafe(
-            self._send_message(discord_id, discord_username, message, is_action=True), self._loop
+        if puppet_postfix == self._puppet_postfix:
+            return
+
+        # Only the nickname changes; the puppets stay connected.
+        old_postfix = self._puppet_postfix
+        self._puppet_postfix = puppet_postfix
+        for puppet in self._puppets.values():
+            nickname = puppet._nickname_original
+            if old_postfix and nickname.endswith(old_postfix):
+                nickname = nickname[: -len(old_postfix)]
+            nickname = f"{nickname}{puppet_postfix}"
+
+            if nickname != puppet._nickname_original:
+                puppet.change_nickname(nickname)
+
+    async def _get_puppet_states(self):
+        states = {"connecting": 0, "joined": 0, "offline_idle": 0}
+        for puppet in self._puppets.values():
+            if puppet.is_offline():
+                states["offline_idle"] += 1
+            elif puppet._joined:
+                states["joined"] += 1
+            else:
+                states["connecting"] += 1
+        return states
+
+    # Thread safe wrapper around functions
+
+    async def get_status(self):
+        return await relay.call(self._get_status(), self._loop)
+
+    async def get_irc_usernames(self, discord_users):
+        return await relay.call(self._get_irc_usernames(discord_users), self._loop)
+
+    async def update_status(self, discord_id, is_offline):
+        await relay.call(self._update_status(discord_id, is_offline), self._loop)
+
+    async def send_message(self, channel, discord_id, discord_username, message, relayed_at):
+        await relay.call(self._send_message(channel, discord_id, discord_username, message, relayed_at), self._loop)
+
+    async def send_action(self, channel, discord_id, discord_username, message, relayed_at):
+        await relay.call(
+            self._send_message(channel, discord_id, discord_username, message, relayed_at, is_action=True),
+            self._loop,
         )
 
-    def stop(self):
-        asyncio.run_coroutine_threadsafe(self._stop(), self._loop)
+    def reload(self, ignore_list, puppet_postfix, idle_timeout):
+        relay.schedule(self._reload(ignore_list, puppet_postfix, idle_timeout), self._loop)
 
+    def get_puppet_states(self):
+        # Called from the metrics thread; wait for the IRC thread to collect them.
+        return asyncio.run_coroutine_threadsafe(self._get_puppet_states(), self._loop).result(timeout=5)
 
-def start(host, port, name, channel, puppet_ip_range, puppet_postfix, ignore_list, idle_timeout):
+    def stop(self):
+        relay.schedule(self._stop(), self._loop)
+
+
+def start(
+    host,
+    port,
+    name,
+    channels,
+    puppet_ip_range,
+    puppet_postfix,
+    ignore_list,
+    idle_timeout,
+    flood_rate,
+    flood_burst,
+    connect_concurrency,
+    state_file,
+    max_puppets,
+    recently_spoken_max,
+    puppet_workers,
+    replay_max_messages,
+    replay_max_age,
+):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     enable_strong_referenced_tasks(loop)
 
-    relay.IRC = IRCRelay(host, port, name, channel, puppet_ip_range, puppet_postfix, ignore_list, idle_timeout)
+    relay.IRC = IRCRelay(
+        host,
+        port,
+        name,
+        channels,
+        puppet_ip_range,
+        puppet_postfix,
+        ignore_list,
+        idle_timeout,
+        flood_rate,
+        flood_burst,
+        connect_concurrency,
+        state_file,
+        max_puppets,
+        recently_spoken_max,
+        puppet_workers,
+        replay_max_messages,
+        replay_max_age,
+    )
+
+    for worker in relay.IRC._puppet_workers:
+        asyncio.get_event_loop().run_until_complete(worker.start())
 
     log.info("Connecting to IRC ...")
     asyncio.get_event_loop().run_until_complete(relay.IRC._connect())
@@ -318,3 +686,51 @@ def start(host, port, name, channel, puppet_ip_range, puppet_postfix, ignore_lis
     finally:
         relay.IRC.connection.disconnect()
         relay.IRC.reactor.loop.close()
+
+
+async def run(
+    host,
+    port,
+    name,
+    channels,
+    puppet_ip_range,
+    puppet_postfix,
+    ignore_list,
+    idle_timeout,
+    flood_rate,
+    flood_burst,
+    connect_concurrency,
+    state_file,
+    max_puppets,
+    recently_spoken_max,
+    puppet_workers,
+    replay_max_messages,
+    replay_max_age,
+):
+    # Like start(), but on an event loop shared with Discord. The relay is
+    # created before the first await, so it exists before Discord needs it.
+    relay.IRC = IRCRelay(
+        host,
+        port,
+        name,
+        channels,
+        puppet_ip_range,
+        puppet_postfix,
+        ignore_list,
+        idle_timeout,
+        flood_rate,
+        flood_burst,
+        connect_concurrency,
+        state_file,
+        max_puppets,
+        recently_spoken_max,
+        puppet_workers,
+        replay_max_messages,
+        replay_max_age,
+    )
+
+    for worker in relay.IRC._puppet_workers:
+        await worker.start()
+
+    log.info("Connecting to IRC ...")
+    await relay.IRC._connect()
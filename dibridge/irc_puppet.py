@@ -1,15 +1,139 @@
 import asyncio
 import irc.client_aio
 import logging
-import random
 import socket
+import time
+
+from . import metrics
+from .connect_scheduler import Backoff
+from .resolver import get_resolver
+from .send_queue import SendQueue
+
+# Puppets are in the same channels as the IRCRelay, so they receive all
+# channel traffic too; but only the IRCRelay handles that. Of these commands,
+# puppets only need the lines about themselves.
+FILTERED_COMMANDS = {b"PRIVMSG", b"NOTICE", b"JOIN", b"PART", b"QUIT", b"NICK", b"KICK"}
+
+
+def _is_for_puppet(line, nickname):
+    # Cheap check on the raw line, so lines that are not for the puppet are
+    # dropped before they are decoded and parsed into events.
+    if line.startswith(b"@"):
+        line = line.partition(b" ")[2]
+    # Lines without a source come from the server itself, like PING.
+    if not line.startswith(b":"):
+        return True
+
+    source, _, line = line[1:].partition(b" ")
+    command, _, params = line.partition(b" ")
+    if command not in FILTERED_COMMANDS:
+        return True
+
+    if command in (b"PRIVMSG", b"NOTICE"):
+        return params.partition(b" ")[0].lower() == nickname
+    if command == b"KICK":
+        params = params.split(b" ", 2)
+        return len(params) > 1 and params[1].lower() == nickname
+    return source.partition(b"!")[0].lower() == nickname
+
+
+class PuppetConnection(irc.client_aio.AioConnection):
+    # Lines are decoded only after they passed the filter.
+    buffer_class = irc.client.buffer.LineBuffer
+
+    def process_data(self, new_data):
+        self.buffer.feed(new_data)
+
+        # The nickname as the server knows it; the library keeps track of it.
+        nickname = self.real_nickname.lower().encode()
+        for line in self.buffer:
+            if not line or not _is_for_puppet(line, nickname):
+                continue
+            self._process_line(line.decode(errors="replace"))
+
+
+class PuppetReactor(irc.client_aio.AioReactor):
+    # A single reactor for all IRC puppets, instead of one per puppet. Events
+    # are dispatched straight to the puppet owning the connection, skipping
+    # the global handler machinery of the reactor.
+    connection_class = PuppetConnection
 
+    def __init__(self):
+        super().__init__()
+        self._puppets = {}
 
-class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
-    def __init__(self, irc_host, irc_port, ipv6_address, nickname, username, channel, remove_puppet_func, idle_timeout):
-        irc.client.SimpleIRCClient.__init__(self)
+    def add_puppet(self, puppet):
+        connection = self.server()
+        self._puppets[connection] = puppet
+        return connection
 
-        self.loop = asyncio.get_event_loop()
+    def remove_puppet(self, connection):
+        if self._puppets.pop(connection, None) is not None:
+            self.connections.remove(connection)
+
+    def _handle_event(self, connection, event):
+        if event.type == "ping":
+            connection.pong(event.target)
+
+        puppet = self._puppets.get(connection)
+        if puppet is None:
+            return
+
+        method = getattr(puppet, f"on_{event.type}", None)
+        if method is not None:
+            method(connection, event)
+
+
+class IRCPuppet:
+    # There can be many puppets, so keep them small.
+    __slots__ = (
+        "connection",
+        "_reactor",
+        "_client",
+        "_irc_host",
+        "_irc_port",
+        "_ipv6_address",
+        "_nickname",
+        "_nickname_original",
+        "_nickname_iteration",
+        "_username",
+        "_joined",
+        "_channels",
+        "_pinger",
+        "_remove_puppet_func",
+        "_nickname_changed_func",
+        "_idle_timeout",
+        "_idle_timer",
+        "_reconnect",
+        "_connect_scheduler",
+        "_timer_wheel",
+        "_backoff",
+        "_resolver",
+        "_last_spoke",
+        "_connected_event",
+        "_send_queue",
+        "_log",
+    )
+
+    def __init__(
+        self,
+        irc_host,
+        irc_port,
+        ipv6_address,
+        nickname,
+        username,
+        channels,
+        remove_puppet_func,
+        nickname_changed_func,
+        idle_timeout,
+        flood_rate,
+        flood_burst,
+        connect_scheduler,
+        timer_wheel,
+        reactor,
+    ):
+        self._reactor = reactor
+        self.connection = reactor.add_puppet(self)
 
         self._irc_host = irc_host
         self._irc_port = irc_port
@@ -19,38 +143,51 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
         self._nickname_iteration = 0
         self._username = username
         self._joined = False
-        self._channel = channel
-        self._pinger_task = None
+        self._channels = set(channels)
+        self._pinger = None
         self._remove_puppet_func = remove_puppet_func
+        self._nickname_changed_func = nickname_changed_func
         self._idle_timeout = idle_timeout
-        self._idle_task = None
+        self._idle_timer = None
         self._reconnect = True
+        self._connect_scheduler = connect_scheduler
+        self._timer_wheel = timer_wheel
+        self._backoff = Backoff()
+        self._resolver = get_resolver(irc_host, socket.AF_INET6)
+        # Used to give recently active users priority when (re)connecting.
+        self._last_spoke = 0
 
         self._connected_event = asyncio.Event()
         self._connected_event.clear()
 
+        self._send_queue = SendQueue(self._connected_event, flood_rate, flood_burst)
+
         self._log = logging.getLogger(f"{__name__}.{self._nickname}")
 
     def on_nicknameinuse(self, client, event):
+        metrics.IRC_NICKNAME_COLLISIONS.inc()
+
         # First iteration, try adding a [d] (Discord, get it?).
         if self._nickname_iteration == 0:
-            self._nickname = f"{self._nickname_original}[d]"
+            self._set_nickname(f"{self._nickname_original}[d]")
             self._nickname_iteration += 1
             client.nick(self._nickname)
             return
 
         # [d] is already in use, try adding a [1], [2], ..
-        self._nickname = f"{self._nickname_original}[{self._nickname_iteration}]"
+        self._set_nickname(f"{self._nickname_original}[{self._nickname_iteration}]")
         self._nickname_iteration += 1
         client.nick(self._nickname)
 
     def on_welcome(self, client, event):
         self._client = client
-        self._client.join(self._channel)
+        self._backoff.reset()
+        for channel in self._channels:
+            self._client.join(channel)
 
-        if self._pinger_task:
-            self._pinger_task.cancel()
-        self._pinger_task = asyncio.create_task(self._pinger())
+        if self._pinger:
+            self._pinger.cancel()
+        self._pinger = self._timer_wheel.call_every(120, self._ping)
 
     def on_privmsg(self, _, event):
         # TODO -- Consider relaying private messages too. Can be useful to identify with NickServ etc.
@@ -59,23 +196,23 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
     # on_pubmsg is done by the IRCRelay, and not by the puppets.
 
     def on_join(self, _client, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
 
         if event.source.nick == self._nickname:
-            self._log.info("Joined %s on IRC", self._channel)
+            self._log.info("Joined %s on IRC", event.target)
             self._joined = True
             self._connected_event.set()
 
     def on_part(self, _client, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
-        self._left(event.source.nick)
+        self._left(event.target, event.source.nick)
 
     def on_kick(self, _client, event):
-        if event.target != self._channel:
+        if event.target not in self._channels:
             return
-        self._left(event.arguments[0])
+        self._left(event.target, event.arguments[0])
 
     def on_kill(self, _client, event):
         # If a user is killed, the ops on IRC must have a good reason.
@@ -83,6 +220,7 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
         self._log.info("Killed by server; removing puppet")
 
         self._reconnect = False
+        self._send_queue.stop()
         asyncio.create_task(self._remove_puppet_func())
 
     def on_nick(self, client, event):
@@ -91,38 +229,47 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
             # Most of the time the name is now something like Guest12345.
             # Try changing back to a name more in line with the user-name.
             self._log.info("Nickname changed to '%s' by server; trying to change it back", event.target)
-            self._nickname = event.target
+            self._set_nickname(event.target)
             asyncio.create_task(self.reclaim_nick())
 
     def on_disconnect(self, _client, event):
         self._log.warning("Disconnected from IRC")
         self._joined = False
         self._connected_event.clear()
-        if self._pinger_task:
-            self._pinger_task.cancel()
+        if self._pinger:
+            self._pinger.cancel()
+            self._pinger = None
 
         if self._reconnect:
+            metrics.IRC_RECONNECTS.inc()
             # Start a task to reconnect us.
-            asyncio.create_task(self.connect())
+            asyncio.create_task(self._reconnect_later())
+        else:
+            # Gone for good, like after a KILL.
+            self._reactor.remove_puppet(self.connection)
+
+    def _set_nickname(self, nickname):
+        old_nickname = self._nickname
+        self._nickname = nickname
+        # Let the relay know, as it keeps an index of all puppet nicknames.
+        self._nickname_changed_func(old_nickname, nickname)
 
-    def _left(self, nick):
-        # If we left the channel, rejoin.
+    def _left(self, channel, nick):
+        # If we left the channel, rejoin. The connection stays ready for the
+        # other channels; the server handles lines in order, so anything sent
+        # to this channel after the JOIN arrives after we rejoined.
         if nick == self._nickname:
-            self._joined = False
-            self._connected_event.clear()
-            self._client.join(self._channel)
+            self._client.join(channel)
             return
 
-    async def _pinger(self):
-        while True:
-            await asyncio.sleep(120)
-            self._client.ping("keep-alive")
+    def _ping(self):
+        self._client.ping("keep-alive")
 
-    async def _idle_timeout_task(self):
-        await asyncio.sleep(self._idle_timeout)
+    def _idle_timeout_expired(self):
+        asyncio.create_task(self._remove_idle())
 
-        self._reconnect = False
-        self._client.disconnect("User went offline on Discord a while ago")
+    async def _remove_idle(self):
+        await self.disconnect("User went offline on Discord a while ago")
         await self._remove_puppet_func()
 
     async def reclaim_nick(self):
@@ -131,7 +278,7 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
         # nicest thing to do.
         await asyncio.sleep(1)
 
-        self._nickname = self._nickname_original
+        self._set_nickname(self._nickname_original)
         self._nickname_iteration = 0
         self._client.nick(self._nickname)
 
@@ -140,29 +287,19 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
         use_ssl = self._irc_port == 6697
 
         while self._reconnect:
-            # As per RFC, getaddrinfo() sorts IPv6 results in some complicated way.
-            # In result, even if the IRC host has multiple IPv6 addresses listed,
-            # we will pick almost always the same one. This gives unneeded pressure
-            # on a single host, instead of distributing the load. So instead, we do
-            # the lookup ourselves, and pick a random one.
-            try:
-                ipv6s = await self.loop.getaddrinfo(
-                    self._irc_host,
-                    None,
-                    family=socket.AF_INET6,
-                    type=socket.SOCK_STREAM,
-                    proto=socket.IPPROTO_TCP,
-                )
-            except socket.gaierror:
-                ipv6s = []
-
-            if not ipv6s:
-                self._log.warning("Failed DNS lookup, retrying in 5 seconds")
-                # When we can't connect, try again in 5 seconds.
-                await asyncio.sleep(5)
+            irc_host_ipv6 = await self._resolver.resolve()
+            if irc_host_ipv6 is None:
+                delay = self._backoff.delay()
+                self._log.warning("Failed DNS lookup, retrying in %.2f seconds", delay)
+                await asyncio.sleep(delay)
                 continue
 
-            irc_host_ipv6 = random.choice(ipv6s)[4][0]
+            # Don't overwhelm the IRC server with connections; especially
+            # after a netsplit, many puppets want to reconnect at once.
+            await self._connect_scheduler.acquire(-self._last_spoke)
+            if not self._reconnect:
+                self._connect_scheduler.release()
+                break
 
             self._log.info(
                 "Connecting to IRC from %s to %s (%s) ...", self._ipv6_address, self._irc_host, irc_host_ipv6
@@ -182,42 +319,78 @@ class IRCPuppet(irc.client_aio.AioSimpleIRCClient):
                         server_hostname=self._irc_host if use_ssl else None,
                     ),
                 )
+                self._resolver.report_success(irc_host_ipv6)
+
+                # The puppet might have been removed while we were connecting.
+                if not self._reconnect:
+                    self.connection.disconnect()
                 break
-            except ConnectionRefusedError:
-                self._log.warning("Connection refused, retrying in 5 seconds")
-                # When we can't connect, try again in 5 seconds.
-                await asyncio.sleep(5)
+            except OSError as e:
+                self._resolver.report_failure(irc_host_ipv6)
+                delay = self._backoff.delay()
+                self._log.warning("Connection failed (%s), retrying in %.2f seconds", e, delay)
+            finally:
+                self._connect_scheduler.release()
+
+            # Back off without holding on to the slot, so other puppets can
+            # connect meanwhile.
+            await asyncio.sleep(delay)
+
+    async def _reconnect_later(self):
+        await asyncio.sleep(self._backoff.delay())
+        await self.connect()
+
+    async def disconnect(self, reason):
+        # Disconnect for good; the puppet will not reconnect after this.
+        self._reconnect = False
+        self._send_queue.stop()
+        self.connection.disconnect(reason)
+        self._reactor.remove_puppet(self.connection)
 
     async def start_idle_timeout(self):
         await self.stop_idle_timeout()
-        self._idle_task = asyncio.create_task(self._idle_timeout_task())
+        self._idle_timer = self._timer_wheel.call_later(self._idle_timeout, self._idle_timeout_expired)
 
     async def stop_idle_timeout(self):
-        if not self._idle_task:
+        if not self._idle_timer:
             return
 
-        self._idle_task.cancel()
-        self._idle_task = None
+        self._idle_timer.cancel()
+        self._idle_timer = None
 
     async def _reset_idle_timeout(self):
-        if not self._idle_task:
+        if not self._idle_timer:
             return
 
         # User is talking while appearing offline. Constantly reset the idle timeout.
         await self.stop_idle_timeout()
         await self.start_idle_timeout()
 
+    def join_channel(self, channel):
+        self._channels.add(channel)
+        # If not connected yet, the channel is joined once we are.
+        if self.connection.is_connected():
+            self.connection.join(channel)
+
     def is_offline(self):
-        return self._idle_task is not None
+        return self._idle_timer is not None
+
+    def change_nickname(self, nickname):
+        # The nickname of the user changed; change it without reconnecting.
+        self._nickname_original = nickname
+        self._nickname_iteration = 0
+        self._set_nickname(nickname)
+        if self.connection.is_connected():
+            self.connection.nick(nickname)
 
-    async def send_message(self, content):
+    async def send_message(self, channel, content, relayed_at):
+        self._last_spoke = time.time()
         await self._reset_idle_timeout()
 
-        await self._connected_event.wait()
-        self._client.privmsg(self._channel, content)
+        self._send_queue.put(relayed_at, self.connection.privmsg, channel, content)
 
-    async def send_action(self, content):
+    async def send_action(self, channel, content, relayed_at):
+        self._last_spoke = time.time()
         await self._reset_idle_timeout()
 
-        await self._connected_event.wait()
-        self._client.action(self._channel, content)
+        self._send_queue.put(relayed_at, self.connection.action, channel, content)
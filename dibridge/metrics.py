@@ -0,0 +1,184 @@
+import http.server
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Metrics are updated from both the Discord and IRC threads, and read from
+# the HTTP server thread.
+_lock = threading.Lock()
+_metrics = []
+# In IRC puppet worker processes, metrics are forwarded to the main process,
+# as only that one serves them.
+_forward_func = None
+
+# Histogram buckets for relay latency, in seconds.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(label, label_value, extra=""):
+    labels = []
+    if label is not None:
+        labels.append(f'{label}="{label_value}"')
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name, description, label=None):
+        self._name = name
+        self._description = description
+        self._label = label
+        # Without labels, there is always a value, even if it is zero.
+        self._values = {} if label else {None: 0}
+        _metrics.append(self)
+
+    def inc(self, label_value=None, amount=1):
+        if _forward_func:
+            _forward_func("inc", self._name, label_value, amount)
+            return
+
+        with _lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} counter"]
+        for label_value, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+            lines.append(f"{self._name}{_format_labels(self._label, label_value)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, label=None, buckets=LATENCY_BUCKETS):
+        self._name = name
+        self._description = description
+        self._label = label
+        self._buckets = buckets
+        # Per label value: [count per bucket, sum, count].
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, label_value=None):
+        if _forward_func:
+            _forward_func("observe", self._name, label_value, value)
+            return
+
+        with _lock:
+            if label_value not in self._values:
+                self._values[label_value] = [[0] * len(self._buckets), 0, 0]
+            buckets, _, _ = data = self._values[label_value]
+
+            for i, bucket in enumerate(self._buckets):
+                if value <= bucket:
+                    buckets[i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} histogram"]
+        for label_value, (buckets, total, count) in sorted(self._values.items(), key=lambda item: str(item[0])):
+            cumulative = 0
+            for bucket, bucket_count in zip(self._buckets, buckets):
+                cumulative += bucket_count
+                labels = _format_labels(self._label, label_value, f'le="{bucket}"')
+                lines.append(f"{self._name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self._label, label_value, 'le="+Inf"')
+            lines.append(f"{self._name}_bucket{labels} {count}")
+            lines.append(f"{self._name}_sum{_format_labels(self._label, label_value)} {total}")
+            lines.append(f"{self._name}_count{_format_labels(self._label, label_value)} {count}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, description, label=None):
+        self._name = name
+        self._description = description
+        self._label = label
+        self._func = None
+        _metrics.append(self)
+
+    def set_function(self, func):
+        # The function returns the current value per label value.
+        self._func = func
+
+    def render(self):
+        lines = [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} gauge"]
+        if self._func is None:
+            return lines
+
+        try:
+            values = self._func()
+        except Exception:
+            log.exception("Failed to collect %s", self._name)
+            return lines
+
+        for label_value, value in sorted(values.items()):
+            lines.append(f"{self._name}{_format_labels(self._label, label_value)} {value}")
+        return lines
+
+
+MESSAGES_RELAYED = Counter("dibridge_messages_relayed_total", "Messages relayed.", "direction")
+RELAY_LATENCY = Histogram(
+    "dibridge_relay_latency_seconds", "Time from receiving a message till it was relayed.", "direction"
+)
+IRC_PUPPETS = Gauge("dibridge_irc_puppets", "IRC puppets per state.", "state")
+IRC_RECONNECTS = Counter("dibridge_irc_reconnects_total", "IRC connections that were lost and are reconnecting.")
+IRC_NICKNAME_COLLISIONS = Counter("dibridge_irc_nickname_collisions_total", "IRC nicknames that were already in use.")
+WEBHOOK_FAILURES = Counter("dibridge_discord_webhook_failures_total", "Discord webhook messages that failed to send.")
+
+
+def forward_to(func):
+    global _forward_func
+    _forward_func = func
+
+
+def apply(kind, name, label_value, value):
+    # Apply a metric update forwarded by a worker process.
+    for metric in _metrics:
+        if metric._name != name:
+            continue
+
+        if kind == "inc":
+            metric.inc(label_value, value)
+        else:
+            metric.observe(value, label_value)
+        return
+
+
+def render():
+    lines = []
+    with _lock:
+        counters = [metric for metric in _metrics if not isinstance(metric, Gauge)]
+        for metric in counters:
+            lines.extend(metric.render())
+    # Gauges are collected outside of the lock, as collecting them might
+    # need to wait for another thread.
+    for metric in _metrics:
+        if isinstance(metric, Gauge):
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def start(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving metrics on http://%s:%d/metrics", host, port)
@@ -0,0 +1,78 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Send SIGUSR1 to a running bridge (or to one of its IRC puppet workers) to
+# sample where its threads spend their time. As every event loop runs in its
+# own thread, this covers both the Discord and the IRC side.
+PROFILE_DURATION = 10
+PROFILE_INTERVAL = 0.005
+# The amount of functions to log per thread.
+PROFILE_TOP = 15
+
+_running = threading.Lock()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _profile():
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    own_ident = threading.get_ident()
+    # Per thread: the amount of samples, and per function how often it was
+    # on the stack (inclusive) and how often it was running (self).
+    samples = collections.Counter()
+    inclusive = collections.defaultdict(collections.Counter)
+    exclusive = collections.defaultdict(collections.Counter)
+
+    end = time.monotonic() + PROFILE_DURATION
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+
+            name = names.get(ident, str(ident))
+            samples[name] += 1
+            exclusive[name][_frame_name(frame)] += 1
+
+            seen = set()
+            while frame is not None:
+                seen.add(_frame_name(frame))
+                frame = frame.f_back
+            inclusive[name].update(seen)
+
+        time.sleep(PROFILE_INTERVAL)
+
+    for name, count in sorted(samples.items()):
+        lines = [f"Profile of thread '{name}' ({count} samples); self% total% function:"]
+        for function, total in inclusive[name].most_common(PROFILE_TOP):
+            lines.append(f"  {exclusive[name][function] * 100 / count:5.1f} {total * 100 / count:5.1f}  {function}")
+        log.info("\n".join(lines))
+
+
+def _run():
+    try:
+        _profile()
+    finally:
+        _running.release()
+
+
+def _on_signal(signum, frame):
+    if not _running.acquire(blocking=False):
+        log.info("Profiler is already running")
+        return
+
+    log.info("Profiling all threads for %d seconds ...", PROFILE_DURATION)
+    threading.Thread(target=_run, name="profiler", daemon=True).start()
+
+
+def install():
+    signal.signal(signal.SIGUSR1, _on_signal)
@@ -0,0 +1,348 @@
+import asyncio
+import functools
+import ipaddress
+import json
+import logging
+import multiprocessing
+import socket
+import time
+
+from openttd_helpers.asyncio_helper import enable_strong_referenced_tasks
+
+from . import metrics
+from . import profiler
+from . import tracing
+from .connect_scheduler import ConnectScheduler
+from .irc_puppet import IRCPuppet
+from .irc_puppet import PuppetReactor
+from .timer_wheel import TimerWheel
+
+log = logging.getLogger(__name__)
+
+# IRC puppets can be spread over worker processes, so TLS, IRC parsing and
+# dispatching of all their connections is not limited to a single core.
+# The IRCRelay stays in the main process, and talks to the puppets via a
+# PuppetProxy. Commands and events are exchanged as JSON lines over a socket.
+
+
+def _current_trace():
+    trace = tracing.current.get()
+    return trace.to_json() if trace else None
+
+
+class PuppetProxy:
+    # Stands in for an IRCPuppet that lives in a worker process. It keeps a
+    # copy of the state the IRCRelay reads from a puppet.
+    def __init__(
+        self,
+        worker,
+        discord_id,
+        ipv6_address,
+        nickname,
+        username,
+        channels,
+        remove_puppet_func,
+        nickname_changed_func,
+    ):
+        self._worker = worker
+        self._discord_id = discord_id
+        self._ipv6_address = ipv6_address
+        self._nickname = nickname
+        self._nickname_original = nickname
+        self._username = username
+        self._channels = set(channels)
+        self._remove_puppet_func = remove_puppet_func
+        self._nickname_changed_func = nickname_changed_func
+        self._joined = False
+        self._offline = False
+        self._last_spoke = 0
+        self._created = False
+
+        self._log = logging.getLogger(f"{__name__}.{self._nickname}")
+        self._worker._proxies[discord_id] = self
+
+    def _send(self, command, **kwargs):
+        # The puppet is created in the worker right before the first command
+        # for it, so it always arrives there before any other command.
+        if not self._created:
+            self._created = True
+            self._worker.send(
+                "create",
+                discord_id=self._discord_id,
+                ipv6_address=str(self._ipv6_address),
+                nickname=self._nickname,
+                username=self._username,
+                channels=sorted(self._channels),
+                last_spoke=self._last_spoke,
+            )
+
+        self._worker.send(command, discord_id=self._discord_id, **kwargs)
+
+    async def connect(self):
+        # The puppet might have been removed before it got to connect.
+        if self._worker._proxies.get(self._discord_id) is not self:
+            return
+
+        self._send("connect")
+
+    async def disconnect(self, reason):
+        self._worker._proxies.pop(self._discord_id, None)
+        self._send("disconnect", reason=reason)
+
+    async def start_idle_timeout(self):
+        self._offline = True
+        self._send("start_idle_timeout")
+
+    async def stop_idle_timeout(self):
+        self._offline = False
+        self._send("stop_idle_timeout")
+
+    def join_channel(self, channel):
+        self._channels.add(channel)
+        self._send("join_channel", channel=channel)
+
+    def is_offline(self):
+        return self._offline
+
+    def change_nickname(self, nickname):
+        self._nickname_original = nickname
+        if self._created:
+            # The worker reports back the nickname actually in use.
+            self._send("change_nickname", nickname=nickname)
+            return
+
+        old_nickname = self._nickname
+        self._nickname = nickname
+        self._nickname_changed_func(old_nickname, nickname)
+
+    async def send_message(self, channel, content, relayed_at):
+        self._last_spoke = time.time()
+        self._send("send_message", channel=channel, content=content, relayed_at=relayed_at, trace=_current_trace())
+
+    async def send_action(self, channel, content, relayed_at):
+        self._last_spoke = time.time()
+        self._send("send_action", channel=channel, content=content, relayed_at=relayed_at, trace=_current_trace())
+
+
+class PuppetWorker:
+    # The main process side of a worker process.
+    def __init__(self, index, irc_host, irc_port, idle_timeout, flood_rate, flood_burst, connect_concurrency):
+        self._index = index
+        self._args = (irc_host, irc_port, idle_timeout, flood_rate, flood_burst, connect_concurrency)
+        self._proxies = {}
+        self._writer = None
+        # Commands sent while the worker is (re)starting; puppets created
+        # meanwhile are created in the new worker once it is up.
+        self._pending = []
+
+    async def start(self):
+        sock, worker_sock = socket.socketpair()
+        # "spawn", as forking a process that is running threads is unsafe.
+        context = multiprocessing.get_context("spawn")
+        self._process = context.Process(
+            target=_worker_main,
+            args=(worker_sock, *self._args),
+            name=f"dibridge-puppets-{self._index}",
+            daemon=True,
+        )
+        self._process.start()
+        worker_sock.close()
+
+        reader, self._writer = await asyncio.open_connection(sock=sock)
+        for line in self._pending:
+            self._writer.write(line)
+        self._pending = []
+        asyncio.create_task(self._reader(reader))
+        log.info("Started IRC puppet worker %d (pid %d)", self._index, self._process.pid)
+
+    def send(self, command, **kwargs):
+        line = json.dumps({"command": command, **kwargs}).encode() + b"\n"
+        if self._writer is None:
+            self._pending.append(line)
+            return
+        self._writer.write(line)
+
+    async def _reader(self, reader):
+        try:
+            await self._read_events(reader)
+        except ConnectionError:
+            pass
+
+        # The worker died; forget its puppets, so they are created again
+        # when their user talks next, and start a fresh worker.
+        log.error("IRC puppet worker %d stopped unexpectedly; restarting it in 5 seconds", self._index)
+        self._writer.close()
+        self._writer = None
+        for proxy in list(self._proxies.values()):
+            del self._proxies[proxy._discord_id]
+            await proxy._remove_puppet_func()
+
+        await asyncio.sleep(5)
+        await self.start()
+
+    async def _read_events(self, reader):
+        while line := await reader.readline():
+            event = json.loads(line)
+            proxy = self._proxies.get(event.get("discord_id"))
+
+            if event["event"] == "metric":
+                metrics.apply(event["kind"], event["name"], event["label_value"], event["value"])
+            elif event["event"] == "span":
+                tracing.emit(event["record"])
+            elif proxy is None:
+                # Puppet was removed by the IRCRelay meanwhile.
+                continue
+            elif event["event"] == "joined":
+                proxy._joined = event["joined"]
+            elif event["event"] == "nickname":
+                proxy._nickname = event["new_nickname"]
+                proxy._nickname_changed_func(event["old_nickname"], event["new_nickname"])
+            elif event["event"] == "removed":
+                del self._proxies[proxy._discord_id]
+                await proxy._remove_puppet_func()
+
+
+class WorkerPuppet(IRCPuppet):
+    # An IRCPuppet that reports its state to the main process.
+    __slots__ = ("_worker", "_discord_id")
+
+    def __init__(self, worker, discord_id, *args):
+        super().__init__(*args)
+        self._worker = worker
+        self._discord_id = discord_id
+
+    def on_join(self, client, event):
+        joined = self._joined
+        super().on_join(client, event)
+        if self._joined != joined:
+            self._worker.send("joined", discord_id=self._discord_id, joined=self._joined)
+
+    def on_disconnect(self, client, event):
+        joined = self._joined
+        super().on_disconnect(client, event)
+        if self._joined != joined:
+            self._worker.send("joined", discord_id=self._discord_id, joined=self._joined)
+
+
+class Worker:
+    # The worker process side; owns the actual IRC puppets.
+    def __init__(self, irc_host, irc_port, idle_timeout, flood_rate, flood_burst, connect_concurrency):
+        self._irc_host = irc_host
+        self._irc_port = irc_port
+        self._idle_timeout = idle_timeout
+        self._flood_rate = flood_rate
+        self._flood_burst = flood_burst
+        self._connect_scheduler = ConnectScheduler(connect_concurrency)
+        self._timer_wheel = TimerWheel()
+        self._reactor = PuppetReactor()
+        self._puppets = {}
+        self._writer = None
+
+    def send(self, event, **kwargs):
+        self._writer.write(json.dumps({"event": event, **kwargs}).encode() + b"\n")
+
+    def _forward_metric(self, kind, name, label_value, value):
+        self.send("metric", kind=kind, name=name, label_value=label_value, value=value)
+
+    def _forward_span(self, record):
+        self.send("span", record=record)
+
+    async def run(self, sock):
+        reader, self._writer = await asyncio.open_connection(sock=sock)
+        # Only the main process serves metrics.
+        metrics.forward_to(self._forward_metric)
+        tracing.forward_to(self._forward_span)
+
+        while line := await reader.readline():
+            command = json.loads(line)
+            await getattr(self, f"_command_{command.pop('command')}")(**command)
+
+        # The main process is gone; so should we.
+        for puppet in self._puppets.values():
+            await puppet.disconnect("Bridge is shutting down")
+
+    async def _command_create(self, discord_id, ipv6_address, nickname, username, channels, last_spoke):
+        puppet = WorkerPuppet(
+            self,
+            discord_id,
+            self._irc_host,
+            self._irc_port,
+            ipaddress.ip_address(ipv6_address),
+            nickname,
+            username,
+            channels,
+            functools.partial(self._removed, discord_id),
+            functools.partial(self._nickname_changed, discord_id),
+            self._idle_timeout,
+            self._flood_rate,
+            self._flood_burst,
+            self._connect_scheduler,
+            self._timer_wheel,
+            self._reactor,
+        )
+        puppet._last_spoke = last_spoke
+        self._puppets[discord_id] = puppet
+
+    async def _command_connect(self, discord_id):
+        if discord_id in self._puppets:
+            asyncio.create_task(self._puppets[discord_id].connect())
+
+    async def _command_disconnect(self, discord_id, reason):
+        puppet = self._puppets.pop(discord_id, None)
+        if puppet is None:
+            return
+
+        await puppet.stop_idle_timeout()
+        await puppet.disconnect(reason)
+
+    async def _command_start_idle_timeout(self, discord_id):
+        if discord_id in self._puppets:
+            await self._puppets[discord_id].start_idle_timeout()
+
+    async def _command_stop_idle_timeout(self, discord_id):
+        if discord_id in self._puppets:
+            await self._puppets[discord_id].stop_idle_timeout()
+
+    async def _command_join_channel(self, discord_id, channel):
+        if discord_id in self._puppets:
+            self._puppets[discord_id].join_channel(channel)
+
+    async def _command_change_nickname(self, discord_id, nickname):
+        if discord_id in self._puppets:
+            self._puppets[discord_id].change_nickname(nickname)
+
+    async def _command_reload(self, idle_timeout):
+        self._idle_timeout = idle_timeout
+        for puppet in self._puppets.values():
+            puppet._idle_timeout = idle_timeout
+
+    async def _command_send_message(self, discord_id, channel, content, relayed_at, trace):
+        if discord_id in self._puppets:
+            with tracing.use(tracing.Trace.from_json(trace)):
+                await self._puppets[discord_id].send_message(channel, content, relayed_at)
+
+    async def _command_send_action(self, discord_id, channel, content, relayed_at, trace):
+        if discord_id in self._puppets:
+            with tracing.use(tracing.Trace.from_json(trace)):
+                await self._puppets[discord_id].send_action(channel, content, relayed_at)
+
+    async def _removed(self, discord_id):
+        if self._puppets.pop(discord_id, None) is not None:
+            self.send("removed", discord_id=discord_id)
+
+    def _nickname_changed(self, discord_id, old_nickname, new_nickname):
+        self.send("nickname", discord_id=discord_id, old_nickname=old_nickname, new_nickname=new_nickname)
+
+
+def _worker_main(sock, *args):
+    # Same logging as the main process sets up via click_logging.
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO
+    )
+    profiler.install()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    enable_strong_referenced_tasks(loop)
+
+    loop.run_until_complete(Worker(*args).run(sock))
@@ -1,2 +1,47 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
 DISCORD = None
 IRC = None
+
+
+def _log_exception(future):
+    if future.cancelled():
+        return
+
+    exception = future.exception()
+    if exception is not None:
+        log.error("Relayed call failed", exc_info=exception)
+
+
+def _is_running_on(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+def schedule(coro, loop):
+    # Run a coroutine on the event loop of the other side of the relay,
+    # without waiting for the result. When both sides share a single event
+    # loop, there is no need to hop threads.
+    if _is_running_on(loop):
+        future = asyncio.ensure_future(coro)
+    else:
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+
+    # Nobody is awaiting the result, so at least make sure failures are logged.
+    future.add_done_callback(_log_exception)
+    return future
+
+
+async def call(coro, loop):
+    # Run a coroutine on the event loop of the other side of the relay, and
+    # wait for its result. When both sides share a single event loop, the
+    # coroutine is awaited directly.
+    if _is_running_on(loop):
+        return await coro
+
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
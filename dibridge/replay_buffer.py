@@ -0,0 +1,33 @@
+import collections
+import time
+
+
+class ReplayBuffer:
+    # Holds messages while the other side is unavailable, so they can be
+    # relayed once it is back. Only the most recent messages are kept: at
+    # most max_messages, and none older than max_age seconds.
+    def __init__(self, max_messages, max_age):
+        self._max_age = max_age
+        self._messages = collections.deque(maxlen=max_messages)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, *args):
+        if self._messages.maxlen == 0:
+            self.dropped += 1
+            return
+
+        # A full deque drops the oldest message itself.
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append((time.monotonic(), args))
+
+    def take(self):
+        # Returns the messages to replay, oldest first, and empties the buffer.
+        expire_before = time.monotonic() - self._max_age
+        messages = [args for added_at, args in self._messages if added_at > expire_before]
+        self.dropped += len(self._messages) - len(messages)
+        self._messages.clear()
+        return messages
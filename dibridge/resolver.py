@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import random
+import socket
+import time
+
+log = logging.getLogger(__name__)
+
+# How long a DNS lookup is considered fresh, in seconds.
+DNS_TTL = 300
+# After a failed lookup, how long to keep using the previous (stale) results
+# before trying again, in seconds.
+DNS_RETRY = 30
+# How long to avoid an address after connecting to it failed, in seconds.
+UNHEALTHY_TIMEOUT = 60
+
+# All resolvers, shared by everything in this process that connects to the same host.
+_resolvers = {}
+
+
+class Resolver:
+    def __init__(self, host, family):
+        self._host = host
+        self._family = family
+        self._addresses = []
+        self._expires = 0
+        self._lookup_task = None
+        # Per address, till when it is considered unhealthy.
+        self._unhealthy = {}
+
+    async def _lookup(self):
+        # As per RFC, getaddrinfo() sorts IPv6 results in some complicated way.
+        # In result, even if the IRC host has multiple IPv6 addresses listed,
+        # we will pick almost always the same one. This gives unneeded pressure
+        # on a single host, instead of distributing the load. So instead, we do
+        # the lookup ourselves, and pick a random one.
+        try:
+            results = await asyncio.get_running_loop().getaddrinfo(
+                self._host,
+                None,
+                family=self._family,
+                type=socket.SOCK_STREAM,
+                proto=socket.IPPROTO_TCP,
+            )
+        except OSError:
+            results = []
+
+        addresses = list(dict.fromkeys(result[4][0] for result in results))
+        if addresses:
+            self._addresses = addresses
+            self._expires = time.monotonic() + DNS_TTL
+        else:
+            if self._addresses:
+                log.warning("DNS lookup for %s failed; using previous results", self._host)
+            self._expires = time.monotonic() + DNS_RETRY
+
+    def _refresh(self):
+        # Only a single lookup at the time; everyone else waits for that one.
+        if self._lookup_task is None:
+            self._lookup_task = asyncio.create_task(self._lookup())
+            self._lookup_task.add_done_callback(self._lookup_done)
+        return self._lookup_task
+
+    def _lookup_done(self, _task):
+        self._lookup_task = None
+
+    async def resolve(self):
+        if not self._addresses:
+            await asyncio.shield(self._refresh())
+        elif time.monotonic() >= self._expires:
+            # Serve the stale results while refreshing in the background.
+            self._refresh()
+
+        if not self._addresses:
+            return None
+
+        now = time.monotonic()
+        healthy = [address for address in self._addresses if self._unhealthy.get(address, 0) <= now]
+        # If nothing is healthy, better try any than none.
+        return random.choice(healthy or self._addresses)
+
+    def report_failure(self, address):
+        self._unhealthy[address] = time.monotonic() + UNHEALTHY_TIMEOUT
+
+    def report_success(self, address):
+        self._unhealthy.pop(address, None)
+
+
+def get_resolver(host, family=socket.AF_UNSPEC):
+    key = (host, family)
+    if key not in _resolvers:
+        _resolvers[key] = Resolver(host, family)
+    return _resolvers[key]
@@ -0,0 +1,92 @@
+import asyncio
+import collections
+import logging
+import time
+
+from . import metrics
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            # Sleep till there is exactly one token available again.
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class SendQueue:
+    def __init__(self, ready_event, flood_rate, flood_burst):
+        self._ready_event = ready_event
+        self._bucket = TokenBucket(flood_rate, flood_burst)
+        # A plain deque, as an asyncio.Queue is a lot bigger, and there is a
+        # SendQueue per IRC puppet.
+        self._queue = collections.deque()
+        self._wakeup = None
+        self._writer_task = None
+
+    def put(self, relayed_at, func, *args):
+        # relayed_at is the (monotonic) time the message was received on
+        # Discord, to measure how long relaying took.
+
+        # Start the writer on first use, as only then we are sure to be
+        # running inside the event loop.
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer())
+
+        trace = tracing.current.get()
+        if trace is not None:
+            tracing.span("queued", trace)
+        self._queue.append((relayed_at, trace, func, args))
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def stop(self):
+        if self._writer_task:
+            self._writer_task.cancel()
+            self._writer_task = None
+
+    async def _writer(self):
+        # A single writer per connection, so lines are always sent in the
+        # order they were queued, at a rate the IRC server accepts.
+        while True:
+            while not self._queue:
+                self._wakeup = asyncio.get_running_loop().create_future()
+                await self._wakeup
+            relayed_at, trace, func, args = self._queue.popleft()
+
+            while True:
+                await self._ready_event.wait()
+                if trace is not None:
+                    tracing.span("connected", trace)
+                await self._bucket.acquire()
+
+                # The connection might have dropped while we were waiting for a token.
+                if self._ready_event.is_set():
+                    break
+
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Failed to send line to IRC")
+                continue
+
+            if trace is not None:
+                tracing.span("sent", trace)
+            metrics.MESSAGES_RELAYED.inc("discord_to_irc")
+            metrics.RELAY_LATENCY.observe(time.monotonic() - relayed_at, "discord_to_irc")
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+
+# Don't write to disk every time someone says something; the last time a user
+# spoke is only used to decide which puppets to restore after a restart.
+LAST_SPOKE_WRITE_INTERVAL = 60
+
+
+class PuppetState:
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS puppets ("
+            "discord_id INTEGER PRIMARY KEY, "
+            "discord_username TEXT NOT NULL, "
+            "nickname TEXT NOT NULL, "
+            "ipv6_address TEXT NOT NULL, "
+            "last_spoke REAL NOT NULL, "
+            "is_offline INTEGER NOT NULL, "
+            "channels TEXT NOT NULL DEFAULT '')"
+        )
+        # State files from before multiple channels could be bridged don't
+        # know which channels a puppet was in; those puppets are not restored.
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(puppets)")]
+        if "channels" not in columns:
+            self._db.execute("ALTER TABLE puppets ADD COLUMN channels TEXT NOT NULL DEFAULT ''")
+        self._db.commit()
+
+        self._last_spoke_written = {}
+
+    def get_puppets(self, since):
+        # IRC channel names can't contain spaces, so the channels are stored space separated.
+        return [
+            puppet[:-1] + (puppet[-1].split(),)
+            for puppet in self._db.execute(
+                "SELECT discord_id, discord_username, nickname, ipv6_address, last_spoke, is_offline, channels "
+                "FROM puppets WHERE last_spoke >= ? ORDER BY last_spoke DESC",
+                (since,),
+            )
+        ]
+
+    def store_puppet(self, discord_id, discord_username, nickname, ipv6_address, last_spoke, channels):
+        self._db.execute(
+            "INSERT OR REPLACE INTO puppets VALUES (?, ?, ?, ?, ?, 0, ?)",
+            (discord_id, discord_username, nickname, str(ipv6_address), last_spoke, " ".join(sorted(channels))),
+        )
+        self._db.commit()
+        self._last_spoke_written[discord_id] = last_spoke
+
+    def update_nickname(self, discord_id, nickname):
+        self._db.execute("UPDATE puppets SET nickname = ? WHERE discord_id = ?", (nickname, discord_id))
+        self._db.commit()
+
+    def update_channels(self, discord_id, channels):
+        self._db.execute(
+            "UPDATE puppets SET channels = ? WHERE discord_id = ?", (" ".join(sorted(channels)), discord_id)
+        )
+        self._db.commit()
+
+    def update_last_spoke(self, discord_id, last_spoke):
+        if last_spoke - self._last_spoke_written.get(discord_id, 0) < LAST_SPOKE_WRITE_INTERVAL:
+            return
+
+        self._db.execute("UPDATE puppets SET last_spoke = ? WHERE discord_id = ?", (last_spoke, discord_id))
+        self._db.commit()
+        self._last_spoke_written[discord_id] = last_spoke
+
+    def update_offline(self, discord_id, is_offline):
+        self._db.execute("UPDATE puppets SET is_offline = ? WHERE discord_id = ?", (int(is_offline), discord_id))
+        self._db.commit()
+
+    def remove_puppet(self, discord_id):
+        self._db.execute("DELETE FROM puppets WHERE discord_id = ?", (discord_id,))
+        self._db.commit()
+        self._last_spoke_written.pop(discord_id, None)
+
+
+class DiscordState:
+    # Remembers what was set up on Discord, so it is not done again on every
+    # start. Without a file, it is only remembered till the bridge stops.
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename or ":memory:")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS discord (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.commit()
+
+    def get(self, key):
+        row = self._db.execute("SELECT value FROM discord WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO discord VALUES (?, ?)", (key, json.dumps(value)))
+        self._db.commit()
+
+    def delete(self, key):
+        self._db.execute("DELETE FROM discord WHERE key = ?", (key,))
+        self._db.commit()
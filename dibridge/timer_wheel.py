@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import math
+import random
+
+log = logging.getLogger(__name__)
+
+
+class Timer:
+    def __init__(self, wheel, callback, interval):
+        self._wheel = wheel
+        self._callback = callback
+        self._interval = interval
+        self._slot = None
+        self._rounds = 0
+
+    def cancel(self):
+        self._wheel._remove(self)
+
+
+class TimerWheel:
+    # A hashed timer wheel: a single task that drives all timers, instead of
+    # a sleeping task per timer. Every tick only the timers in the current
+    # slot are looked at; timers further away than a single revolution wait
+    # a few rounds in their slot.
+    def __init__(self, tick=1, slots=512):
+        self._tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._position = 0
+        self._task = None
+
+    def call_later(self, delay, callback):
+        timer = Timer(self, callback, None)
+        self._insert(timer, delay)
+        return timer
+
+    def call_every(self, interval, callback):
+        # The first call is at a random moment within the interval, so timers
+        # created at the same moment don't all fire at the same tick.
+        timer = Timer(self, callback, interval)
+        self._insert(timer, random.uniform(0, interval))
+        return timer
+
+    def _insert(self, timer, delay):
+        # Start the wheel on first use, as only then we are sure to be
+        # running inside the event loop.
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        ticks = max(1, math.ceil(delay / self._tick))
+        timer._rounds = (ticks - 1) // len(self._slots)
+        timer._slot = (self._position + ticks) % len(self._slots)
+        self._slots[timer._slot].add(timer)
+
+    def _remove(self, timer):
+        if timer._slot is not None:
+            self._slots[timer._slot].discard(timer)
+            timer._slot = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+
+        while True:
+            # Sleep till an absolute moment, so ticks don't drift.
+            next_tick += self._tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+
+            self._position = (self._position + 1) % len(self._slots)
+            for timer in list(self._slots[self._position]):
+                if timer._rounds > 0:
+                    timer._rounds -= 1
+                    continue
+
+                self._remove(timer)
+                if timer._interval is not None:
+                    self._insert(timer, timer._interval)
+
+                try:
+                    timer._callback()
+                except Exception:
+                    log.exception("Timer callback failed")
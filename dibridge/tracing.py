@@ -0,0 +1,101 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# When enabled, every relayed message gets a trace, and a span is emitted
+# for every stage it passes through. Each span has the time since the
+# message was received, so it shows where the time went: waiting for an
+# IRC puppet to connect, hopping between threads, rate limits, etc.
+
+# The trace of the message being relayed, if any. Context variables follow
+# tasks, also when they are scheduled on the event loop of the other thread.
+current = contextvars.ContextVar("trace", default=None)
+
+_enabled = False
+# In IRC puppet worker processes, spans are forwarded to the main process,
+# as only that one emits them.
+_forward_func = None
+
+
+class Trace:
+    __slots__ = ("trace_id", "direction", "started_at")
+
+    def __init__(self, trace_id, direction, started_at):
+        self.trace_id = trace_id
+        self.direction = direction
+        # Monotonic time; on Linux this is the same clock in every process.
+        self.started_at = started_at
+
+    def to_json(self):
+        return [self.trace_id, self.direction, self.started_at]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data) if data else None
+
+
+def enable(filename):
+    global _enabled
+    _enabled = True
+
+    # Without a file, spans are logged like everything else.
+    if filename:
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(logging.INFO)
+
+
+def forward_to(func):
+    global _forward_func
+    _forward_func = func
+
+
+def start(direction, relayed_at):
+    # Start the trace of a message that was just received, for the current task.
+    if not _enabled:
+        return None
+
+    trace = Trace(os.urandom(8).hex(), direction, relayed_at)
+    current.set(trace)
+    span("received", trace)
+    return trace
+
+
+@contextlib.contextmanager
+def use(trace):
+    token = current.set(trace)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+def span(stage, trace=None):
+    if trace is None:
+        trace = current.get()
+        if trace is None:
+            return
+
+    record = {
+        "trace_id": trace.trace_id,
+        "direction": trace.direction,
+        "stage": stage,
+        "elapsed": round(time.monotonic() - trace.started_at, 6),
+        "pid": os.getpid(),
+    }
+    emit(record)
+
+
+def emit(record):
+    if _forward_func:
+        _forward_func(record)
+        return
+
+    log.info(json.dumps(record))
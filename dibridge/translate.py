@@ -0,0 +1,116 @@
+import re
+import textwrap
+
+# The maximum length of a message on IRC. This is different per network,
+# but 400 seems like a safe value for most modern IRC networks.
+IRC_MAX_LINE_LENGTH = 400
+
+# Everything in a Discord message that needs translating for IRC:
+# - user mentions (<@123456789>)
+# - channel mentions (<#123456789>)
+# - role mentions (<@&123456789>)
+# - @everyone and @here
+# - emojis (<:emoji:123456789>; sadly, discord.py library doesn't have support for it)
+# - Windows / old Mac newlines
+REGEX_TOKENS = re.compile(
+    r"<@(?P<user>[0-9]+)>"
+    r"|<#(?P<channel>[0-9]+)>"
+    r"|<@&(?P<role>[0-9]+)>"
+    r"|@(?P<everyone>everyone|here)"
+    r"|<:(?P<emoji>\w+):[0-9]{15,20}>"
+    r"|(?P<newline>\r\n?)"
+)
+# textwrap treats these characters special; a line without them that fits
+# on a single IRC line can be sent as-is.
+REGEX_TEXTWRAP_SPECIAL = re.compile(r"[\t\x0b\x0c]")
+
+
+def _resolve(match, users, channels, roles):
+    kind = match.lastgroup
+    if kind == "user":
+        return users.get(int(match.group("user")))
+    if kind == "channel":
+        name = channels.get(int(match.group("channel")))
+        return None if name is None else f"Discord channel #{name}"
+    if kind == "role":
+        return roles.get(int(match.group("role")))
+    if kind == "everyone":
+        return "all"
+    if kind == "emoji":
+        return f":{match.group('emoji')}:"
+    return None
+
+
+def _replace_tokens(content, users, channels, roles, skip=None):
+    pieces = []
+    position = 0
+
+    for match in REGEX_TOKENS.finditer(content):
+        if match.lastgroup == "newline":
+            replacement = "\n"
+        elif match.group(0) == skip:
+            continue
+        else:
+            replacement = _resolve(match, users, channels, roles)
+            if replacement is None:
+                continue
+
+        pieces.append(content[position : match.start()])
+        pieces.append(replacement)
+        position = match.end()
+
+    pieces.append(content[position:])
+    return "".join(pieces)
+
+
+def _translate_content(content, users, channels, roles):
+    match = REGEX_TOKENS.match(content)
+    if match and match.lastgroup != "newline":
+        name = _resolve(match, users, channels, roles)
+        rest = content[match.end() :]
+
+        # At the beginning of the line, on IRC it is custom to add a ": " behind the highlight.
+        if name is not None and rest and not rest.startswith(":"):
+            # Other mentions of the same user / channel / role stay as they
+            # are; this is how the bridge always behaved. Emojis don't have
+            # this behaviour.
+            skip = match.group(0) if match.lastgroup != "emoji" else None
+            return f"{name}: " + _replace_tokens(rest.strip(), users, channels, roles, skip)
+
+    return _replace_tokens(content, users, channels, roles)
+
+
+def discord_to_irc(content, users, channels, roles):
+    # Translate a Discord message to IRC lines, given lookup tables (ID to
+    # name) for the users, channels and roles mentioned in the message.
+    # Returns whether the message is an action, and the lines to send.
+    content = _translate_content(content, users, channels, roles).strip()
+
+    # On Discord text between _ and _ is what IRC calls an action.
+    # IRC has a limit on message size; if reached, make the action multi-line too.
+    if (
+        content.startswith("_")
+        and content.endswith("_")
+        and len(content) > 2
+        and "\n" not in content
+        and len(content) < IRC_MAX_LINE_LENGTH
+    ):
+        return True, [content[1:-1]]
+
+    lines = []
+    for full_line in content.split("\n"):
+        # On Discord, you make code-blocks by starting and finishing with ```.
+        # This is considered noise on IRC however. So we ignore those lines.
+        if full_line == "```":
+            continue
+
+        full_line = full_line.strip()
+        if len(full_line) <= IRC_MAX_LINE_LENGTH and not REGEX_TEXTWRAP_SPECIAL.search(full_line):
+            if full_line:
+                lines.append(full_line)
+            continue
+
+        # Split the message in lines of at most IRC_MAX_LINE_LENGTH characters, breaking on words.
+        lines.extend(textwrap.wrap(full_line, IRC_MAX_LINE_LENGTH))
+
+    return False, lines
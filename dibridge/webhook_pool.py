@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+
+from . import metrics
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+
+class PooledWebhook:
+    def __init__(self, webhook, send_func):
+        self.webhook = webhook
+        self.pending = 0
+
+        self._send_func = send_func
+        self._queue = asyncio.Queue()
+        self._writer_task = None
+
+    def _ensure_writer(self):
+        # After a reconnect, Discord runs on a new event loop; the writer of
+        # the previous one was cancelled when that loop stopped, and its queue
+        # is bound to it. Move what is still queued to a new writer.
+        loop = asyncio.get_running_loop()
+        if self._writer_task is not None and not self._writer_task.done() and self._writer_task.get_loop() is loop:
+            return
+
+        queue = asyncio.Queue()
+        while not self._queue.empty():
+            queue.put_nowait(self._queue.get_nowait())
+        self._queue = queue
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def put(self, username, message, relayed_at, done_func):
+        self._ensure_writer()
+
+        trace = tracing.current.get()
+        if trace is not None:
+            tracing.span("queued", trace)
+
+        self.pending += 1
+        self._queue.put_nowait((username, message, relayed_at, trace, done_func))
+
+    async def _writer(self):
+        # Messages on a single webhook are sent one by one, so they arrive in
+        # the order they were queued.
+        while True:
+            username, message, relayed_at, trace, done_func = await self._queue.get()
+            if trace is not None:
+                tracing.span("sending", trace)
+
+            # The webhook can be replaced while sending, if it was deleted.
+            webhook = self.webhook
+            try:
+                await self._send_func(webhook, username, message)
+                if trace is not None:
+                    tracing.span("sent", trace)
+
+                metrics.MESSAGES_RELAYED.inc("irc_to_discord")
+                metrics.RELAY_LATENCY.observe(time.monotonic() - relayed_at, "irc_to_discord")
+            except Exception:
+                metrics.WEBHOOK_FAILURES.inc()
+                log.exception("Failed to send message of %s via webhook %s", username, webhook.id)
+            finally:
+                self.pending -= 1
+                done_func()
+
+
+class WebhookPool:
+    def __init__(self, send_func):
+        self._send_func = send_func
+        self._webhooks = {}
+        # Per username, the webhook they have messages pending on, and how many.
+        self._assignments = {}
+
+    def set_webhooks(self, webhooks):
+        # Keep the queues of webhooks we already knew about. The queues of
+        # webhooks that are gone continue on a new webhook instead, so
+        # messages already queued keep their order.
+        webhook_ids = {webhook.id for webhook in webhooks}
+        new_webhooks = [webhook for webhook in webhooks if webhook.id not in self._webhooks]
+        for webhook_id in list(self._webhooks):
+            if webhook_id in webhook_ids:
+                continue
+
+            pooled = self._webhooks.pop(webhook_id)
+            if new_webhooks:
+                pooled.webhook = new_webhooks.pop(0)
+                self._webhooks[pooled.webhook.id] = pooled
+
+        for webhook in webhooks:
+            if webhook.id in self._webhooks:
+                self._webhooks[webhook.id].webhook = webhook
+                # Messages queued before a reconnect are sent now.
+                if self._webhooks[webhook.id].pending:
+                    self._webhooks[webhook.id]._ensure_writer()
+            else:
+                self._webhooks[webhook.id] = PooledWebhook(webhook, self._send_func)
+
+    def send(self, username, message, relayed_at):
+        if not self._webhooks:
+            log.warning("Can't relay message from %s to Discord: no webhook available", username)
+            return
+
+        # As long as a user has messages pending on a webhook, new messages go
+        # to the same webhook; otherwise they would be sent out of order.
+        # Otherwise, pick the webhook with the least amount of work queued.
+        assignment = self._assignments.get(username)
+        if assignment is None:
+            pooled = min(self._webhooks.values(), key=lambda pooled: pooled.pending)
+            assignment = self._assignments[username] = [pooled, 0]
+
+        assignment[1] += 1
+        assignment[0].put(username, message, relayed_at, lambda: self._done(username))
+
+    def _done(self, username):
+        assignment = self._assignments[username]
+        assignment[1] -= 1
+        if assignment[1] == 0:
+            del self._assignments[username]
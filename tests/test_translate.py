@@ -0,0 +1,184 @@
+import random
+import re
+import textwrap
+
+import pytest
+
+from dibridge.translate import IRC_MAX_LINE_LENGTH
+from dibridge.translate import discord_to_irc
+
+
+def legacy_discord_to_irc(content, mentions, channel_mentions, role_mentions):
+    # Frozen copy of the translation RelayDiscord.on_message did before it
+    # moved to dibridge.translate. Mentions are lists of (id, name), in the
+    # order Discord gives them.
+    def replace_mention(prefix, postfix, id, name, content):
+        identifer = f"{prefix}{id}{postfix}"
+
+        if content.startswith(f"{identifer}") and not content.startswith(f"{identifer}:") and content != f"{identifer}":
+            return f"{name}: " + content[len(f"{identifer}") :].strip()
+
+        return content.replace(f"{identifer}", name)
+
+    for id, name in mentions:
+        content = replace_mention("<@", ">", id, name, content)
+    for id, name in channel_mentions:
+        content = replace_mention("<#", ">", id, f"Discord channel #{name}", content)
+    for id, name in role_mentions:
+        content = replace_mention("<@&", ">", id, name, content)
+    content = replace_mention("@", "", "everyone", "all", content)
+    content = replace_mention("@", "", "here", "all", content)
+
+    def find_emojis(content):
+        return [{"id": id, "name": name} for name, id in re.findall(r"<:(\w+):([0-9]{15,20})>", content)]
+
+    for emoji in find_emojis(content):
+        content = replace_mention("<:", ">", f"{emoji['name']}:{emoji['id']}", f":{emoji['name']}:", content)
+
+    content = content.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+    if (
+        content.startswith("_")
+        and content.endswith("_")
+        and len(content) > 2
+        and "\n" not in content
+        and len(content) < IRC_MAX_LINE_LENGTH
+    ):
+        return True, [content[1:-1]]
+
+    lines = []
+    for full_line in content.split("\n"):
+        if full_line == "```":
+            continue
+
+        for line in textwrap.wrap(full_line.strip(), IRC_MAX_LINE_LENGTH):
+            lines.append(line)
+    return False, lines
+
+
+def translate(content, mentions=(), channel_mentions=(), role_mentions=()):
+    result = discord_to_irc(content, dict(mentions), dict(channel_mentions), dict(role_mentions))
+    assert result == legacy_discord_to_irc(content, mentions, channel_mentions, role_mentions)
+    return result
+
+
+USERS = [(1, "TrueBrain"), (12, "glx"), (123456789012345678, "frosch")]
+CHANNELS = [(1, "general"), (42, "development")]
+ROLES = [(1, "Developers"), (7, "Moderators")]
+EMOJI = "<:openttd:123456789012345678>"
+
+
+def test_leading_mention():
+    assert translate("<@1> hello", USERS) == (False, ["TrueBrain: hello"])
+
+
+def test_leading_mention_with_colon():
+    assert translate("<@1>: hello", USERS) == (False, ["TrueBrain: hello"])
+
+
+def test_only_mention():
+    assert translate("<@1>", USERS) == (False, ["TrueBrain"])
+
+
+def test_leading_mention_repeated():
+    # Repeats of a leading mention were never translated; this is kept as-is.
+    assert translate("<@1> hello <@1> and <@12>", USERS) == (False, ["TrueBrain: hello <@1> and glx"])
+
+
+def test_inline_mentions():
+    assert translate("ask <@12> in <#42> or <@&7>", USERS, CHANNELS, ROLES) == (
+        False,
+        ["ask glx in Discord channel #development or Moderators"],
+    )
+
+
+def test_unknown_mention():
+    assert translate("<@99> hello <@1>", USERS) == (False, ["<@99> hello TrueBrain"])
+
+
+def test_leading_emoji():
+    # Like a mention, a leading emoji gets a ": "; unlike mentions, repeats are translated too.
+    assert translate(f"{EMOJI} nice {EMOJI}") == (False, [":openttd:: nice :openttd:"])
+
+
+def test_emoji_with_short_id():
+    assert translate("<:openttd:1234>") == (False, ["<:openttd:1234>"])
+
+
+def test_here_everyone():
+    assert translate("@here @everyone look") == (False, ["all: all look"])
+
+
+def test_newlines():
+    assert translate("one\r\ntwo\rthree\nfour") == (False, ["one", "two", "three", "four"])
+
+
+def test_code_block():
+    assert translate("```\ncode\n```\n ``` \n```python") == (False, ["code", "```", "```python"])
+
+
+def test_empty_lines():
+    assert translate("one\n\n  \ntwo") == (False, ["one", "two"])
+
+
+def test_action():
+    assert translate("_waves_") == (True, ["waves"])
+
+
+def test_not_an_action():
+    assert translate("__") == (False, ["__"])
+    assert translate("_one\ntwo_") == (False, ["_one", "two_"])
+
+
+def test_long_action():
+    content = "_" + "word " * 80 + "_"
+    is_action, lines = translate(content)
+    assert not is_action
+    assert len(lines) == 2
+
+
+def test_wrapping():
+    content = " ".join(f"word{i}" for i in range(100))
+    is_action, lines = translate(content)
+    assert not is_action
+    assert len(lines) == 2
+    assert all(len(line) <= IRC_MAX_LINE_LENGTH for line in lines)
+    assert " ".join(lines) == content
+
+
+def test_wrapping_long_word():
+    assert translate("a" * 1000) == (False, ["a" * 400, "a" * 400, "a" * 200])
+
+
+def test_tabs():
+    translate("one\ttwo\x0bthree\x0cfour")
+
+
+def _random_content(rng):
+    tokens = [
+        lambda: rng.choice(["hello", "world", "OpenTTD", "a", ":", "_", "```", "@", "<", ">", "#"]),
+        lambda: " ",
+        lambda: " ",
+        lambda: rng.choice(["\n", "\r\n", "\r", "\t"]),
+        lambda: "x" * rng.randint(1, 450),
+        lambda: f"<@{rng.choice([1, 12, 99, 123456789012345678])}>",
+        lambda: f"<#{rng.choice([1, 42, 99])}>",
+        lambda: f"<@&{rng.choice([1, 7, 99])}>",
+        lambda: rng.choice(["@everyone", "@here", "@everyones"]),
+        lambda: f"<:{rng.choice(['openttd', 'tt'])}:{rng.choice(['123456789012345678', '1234'])}>",
+    ]
+    return "".join(rng.choice(tokens)() for _ in range(rng.randint(0, 20)))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_identical_to_legacy(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        content = _random_content(rng)
+        mentions = rng.sample(USERS, rng.randint(0, len(USERS)))
+        channel_mentions = rng.sample(CHANNELS, rng.randint(0, len(CHANNELS)))
+        role_mentions = rng.sample(ROLES, rng.randint(0, len(ROLES)))
+
+        assert discord_to_irc(
+            content, dict(mentions), dict(channel_mentions), dict(role_mentions)
+        ) == legacy_discord_to_irc(content, mentions, channel_mentions, role_mentions), repr(content)